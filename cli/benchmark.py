@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""Measure 'grocycli.py add recipe --auto' end to end against mockgrocy.py.
+
+A corpus of recipe JSON is generated from the catalog of the mock (or a
+crawled corpus is given with --corpus) and imported by grocycli.py in a
+child process. Every run reports recipes/s, requests per recipe, p50/p99
+latency of the requests as served by the mock, and the peak memory of
+grocycli.py.
+
+Arguments after -- are passed to grocycli.py, e.g.
+
+    cli/benchmark.py --recipes 200 --latency 0.02 -- --uploads 8"""
+
+from argparse import REMAINDER, ArgumentParser
+import json
+from os import environ, makedirs, path
+import random
+from resource import RUSAGE_CHILDREN, getrusage
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import monotonic
+
+from mockgrocy import MockGrocy, product_names, serve
+
+GROCYCLI = path.join(path.dirname(path.abspath(__file__)), 'grocycli.py')
+
+# Unit texts the generated ingredients use, as recipes write them
+unit_texts = ['cup', 'cups', 'tbsp', 'tablespoons', 'tsp', 'teaspoon', 'oz', 'ounces', 'lb',
+        'pound', 'gram', 'ml', 'pinch', 'quart']
+amount_texts = ['1', '2', '3', '1/2', '1/4', '1 1/2', '2 to 3', '0.5']
+
+def make_corpus(directory, recipes, products, ingredients, seed=0):
+    """Write recipes JSON files of up to ingredients lines each, using the
+    names of the first products of the mock catalog."""
+    rand = random.Random(seed)
+    names = product_names(products)
+    makedirs(directory, exist_ok=True)
+
+    for idx in range(recipes):
+        lines = []
+        for _ in range(rand.randint(max(ingredients // 2, 1), ingredients)):
+            lines.append(f'{rand.choice(amount_texts)} {rand.choice(unit_texts)} {rand.choice(names)}')
+
+        recipe = {
+                'title': f'Benchmark recipe {idx}',
+                'author': 'benchmark',
+                'host': 'example.com',
+                'canonical_url': f'https://example.com/recipe/{idx}',
+                'category': 'Benchmark',
+                'total_time': rand.randint(10, 120),
+                'yields': f'{rand.randint(1, 8)} servings',
+                'instructions_list': ['Mix everything.', 'Cook it.'],
+                'nutrients': {'calories': '100 kcal'},
+                'ingredients': lines,
+                'ingredient_groups': [{'purpose': None, 'ingredients': lines}],
+                }
+
+        with open(path.join(directory, f'recipe-{idx:06}.json'), 'w') as fp:
+            json.dump(recipe, fp)
+
+def run_import(port, corpus, cache, extra, log):
+    """Run grocycli.py against the mock. Returns (seconds, exit code)."""
+    env = dict(environ, GROCY_URL='http://127.0.0.1', GROCY_PORT=str(port),
+            GROCY_API_KEY='benchmark', GROCYCLI_CACHE=cache)
+    # Without --restart a warm run would skip the recipes the last one imported
+    cmd = [sys.executable, GROCYCLI, 'add', 'recipe', corpus, '--auto', '--restart', *extra]
+
+    start = monotonic()
+    res = subprocess.run(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return (monotonic() - start, res.returncode)
+
+def benchmark(args):
+    grocy = MockGrocy(products=args.products, latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, seed=args.seed)
+    server = serve(grocy)
+    Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    results = []
+    with TemporaryDirectory(prefix='grocycli-benchmark-') as tmp:
+        corpus = args.corpus
+        if not corpus:
+            corpus = path.join(tmp, 'corpus')
+            make_corpus(corpus, args.recipes, args.products, args.ingredients, seed=args.seed)
+
+        log = open(args.log, 'w') if args.log else subprocess.DEVNULL
+        try:
+            for run in range(args.runs):
+                # A fresh cache makes every run import the whole corpus again
+                cache = path.join(tmp, 'cache' if args.warm else f'cache-{run}')
+                recipes = grocy.stats()['objects']['recipes']
+                grocy.reset()
+
+                (seconds, code) = run_import(port, corpus, cache, args.grocycli, log)
+
+                stats = grocy.stats()
+                imported = stats['objects']['recipes'] - recipes
+                # ru_maxrss is the largest of the children waited for so far
+                results.append({
+                        'run': run,
+                        'seconds': round(seconds, 3),
+                        'exit_code': code,
+                        'imported': imported,
+                        'recipes_per_second': round(imported / seconds, 2) if seconds else None,
+                        'requests': stats['total'],
+                        'requests_per_recipe': round(stats['total'] / imported, 2) if imported else None,
+                        'errors_injected': stats['errors'],
+                        'p50_ms': round(stats['latency_ms']['p50'] or 0, 2),
+                        'p99_ms': round(stats['latency_ms']['p99'] or 0, 2),
+                        'peak_rss_mb': round(getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+                        'requests_by_endpoint': stats['requests'],
+                        })
+        finally:
+            if args.log:
+                log.close()
+            server.shutdown()
+
+    return results
+
+def report(results):
+    for x in results:
+        print(f'Run {x["run"]}: imported {x["imported"]} recipes in {x["seconds"]}s '
+                f'(exit code {x["exit_code"]})')
+        print(f'  {x["recipes_per_second"]} recipes/s, {x["requests_per_recipe"]} requests/recipe, '
+                f'{x["errors_injected"]} injected errors')
+        print(f'  request latency p50 {x["p50_ms"]} ms, p99 {x["p99_ms"]} ms')
+        print(f'  peak memory {x["peak_rss_mb"]} MiB')
+        for (endpoint, count) in sorted(x['requests_by_endpoint'].items()):
+            print(f'    {count:8} {endpoint}')
+
+def parseargs():
+    parser = ArgumentParser(description='Benchmark recipe imports of grocycli.py against a mock Grocy.')
+    parser.add_argument('--recipes', type=int, default=100, help='Number of recipes to generate')
+    parser.add_argument('--ingredients', type=int, default=30, help='Most ingredients per generated recipe')
+    parser.add_argument('--corpus', type=str, help='Import this corpus instead of a generated one')
+    parser.add_argument('--products', type=int, default=1000, help='Number of products in the mock catalog')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds the mock adds to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='Up to this many more random seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests the mock fails')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus, catalog and errors')
+    parser.add_argument('--runs', type=int, default=1, help='Number of imports to run')
+    parser.add_argument('--warm', action='store_true', default=False,
+            help='Keep the catalog cache and resolution table between runs')
+    parser.add_argument('--log', type=str, help='Write the output of grocycli.py to this file')
+    parser.add_argument('--json', action='store_true', default=False, help='Print the results as JSON')
+    parser.add_argument('grocycli', nargs=REMAINDER, help='Arguments passed to grocycli.py after --')
+    args = parser.parse_args()
+
+    if args.grocycli and args.grocycli[0] == '--':
+        args.grocycli = args.grocycli[1:]
+
+    return args
+
+if __name__ == '__main__':
+    args = parseargs()
+    results = benchmark(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
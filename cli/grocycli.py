@@ -1,32 +1,52 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
 from difflib import SequenceMatcher
+from functools import lru_cache
+from glob import glob, has_magic
+from hashlib import sha1
+from heapq import nlargest
+from itertools import chain
 import json
-from os import environ
-from pprint import pprint
+import logging
+from os import cpu_count, environ, getpid, makedirs, path, remove, replace
+from queue import Empty, LifoQueue
 import re
+import sqlite3
 from sys import exit
-from urllib.error import HTTPError
-from urllib.request import Request, urlopen
-
-from pygrocy import Grocy
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter, sleep, time
+from urllib.parse import quote, urlparse
 
 api_key = environ.get('GROCY_API_KEY')
 url = environ.get('GROCY_URL')
 port = environ.get('GROCY_PORT', 80)
-headers = {'GROCY-API-KEY': api_key,
-        'accept': 'application/json',
-        'Content-Type': 'application/json',
-        }
+# Seconds to wait for Grocy to accept a connection or answer a request
+timeout = float(environ.get('GROCY_TIMEOUT', 30))
+# Times to retry a request after a 5xx response or a dropped connection
+retries = int(environ.get('GROCY_RETRIES', 3))
+# Directory of the product and unit catalogs cached between runs
+cache_dir = environ.get('GROCYCLI_CACHE',
+        path.join(environ.get('XDG_CACHE_HOME', path.expanduser('~/.cache')), 'grocycli'))
+# Version of the cached catalog layout. Older caches are downloaded again.
+catalog_format = 2
+# Seconds between writes of --metrics
+metrics_interval = 15
+
+log = logging.getLogger('grocycli')
 
 grocy = None
+parser = None
+journal = None
+resolutions = None
 unit_nicknames = {
         ' c ': 'cup',
         'clove': 'teaspoon',
         'cup': 'cup',
-        'dash': 'gram',
-        'dashes': 'gram',
+        'dash': 'dash',
+        'dashes': 'dash',
         'floz': 'fluid ounce',
         'fluid ounce': 'fluid ounce',
         ' g ': 'gram',
@@ -39,7 +59,7 @@ unit_nicknames = {
         'ml': 'milliliter',
         'oz': 'ounce',
         'ounce': 'ounce',
-        'pinch': 'ounce',
+        'pinch': 'pinch',
         'pound': 'pound',
         'qt': 'quart',
         'quart': 'quart',
@@ -49,6 +69,12 @@ unit_nicknames = {
         'tsp': 'teaspoon',
         }
 
+# Units Grocy often doesn't define, mapped to a (unit, amount of that unit)
+unit_fallbacks = {
+        'dash': ['teaspoon', 1/8],
+        'pinch': ['teaspoon', 1/16],
+        }
+
 # Commonly used ingredient names mapped to a (name, note)
 product_nicknames = {
         'all purpose flour': ['flour', None],
@@ -85,124 +111,854 @@ prep_verbs = [
         'smooth',
         ]
 
+class LazyPattern():
+    """A regular expression compiled when first used, so that commands which
+    never parse an ingredient don't compile the large ones."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.compiled = None
+
+    def __getattr__(self, name):
+        if self.compiled is None:
+            self.compiled = re.compile(self.pattern)
+
+        return getattr(self.compiled, name)
+
+id_pat = re.compile(r'/\d+')
 money_pat = re.compile(r'\(\$\d+\.\d\d\)')
-amount_pat = r'(?P<amount>\d+ to \d+|\d+\s?-\s?\d+|\d* ?\d+/\d+|\d+(?:\.\d+)?)'
-unit_pat = f'(?P<unit>{"|".join(unit_nicknames)})?'
-product_pat = r'(?P<product>[\w\s-]*\w+)'
-note_pat = r'(?P<note>,\s+[\s\w]+|\([\w\s]+\))*'
-full_pat = amount_pat + r'\s+' + unit_pat + r's?\s*' + product_pat + r'\s*' \
-        + note_pat
-ingredient_pat = re.compile(full_pat)
-can_pat = re.compile(r'\d+\s+\(\s*' + amount_pat + r'\s+' + unit_pat \
-        + r's?\s*\)\s+can\s+' + product_pat + r'\s*' + note_pat)
-can_pat2 = re.compile(r'\d+\s+' + amount_pat + r'\s*' + unit_pat \
-        + r'\s*\.\s+can\s+' + product_pat + r'\s*' + note_pat)
+junk_pat = re.compile(r'[^\w\s\./]')
+unit_search_pat = LazyPattern('|'.join(
+        [re.escape(x) for x in sorted(unit_nicknames, key=len, reverse=True)]))
+
+# {p} is replaced with a prefix so that one pattern can hold every form
+amount_pat = r'(?P<{p}amount>\d+ to \d+|\d+\s?-\s?\d+|\d* ?\d+/\d+|\d+(?:\.\d+)?)'
+unit_pat = f'(?P<{{p}}unit>{"|".join(unit_nicknames)})?'
+product_pat = r'(?P<{p}product>[\w\s-]*\w+)'
+note_pat = r'(?P<{p}note>,\s+[\s\w]+|\([\w\s]+\))*'
+
+# Ingredient forms, in the order they are tried
+ingredient_forms = {
+        # 2 15 oz. can black beans
+        'can2': r'\d+\s+' + amount_pat + r'\s*' + unit_pat + r'\s*\.\s+can\s+'
+            + product_pat + r'\s*' + note_pat,
+        # 2 (15 ounce) can black beans
+        'can': r'\d+\s+\(\s*' + amount_pat + r'\s+' + unit_pat + r's?\s*\)\s+can\s+'
+            + product_pat + r'\s*' + note_pat,
+        # 1 1/2 cups flour, sifted
+        'full': amount_pat + r'\s+' + unit_pat + r's?\s*' + product_pat + r'\s*'
+            + note_pat,
+        }
+ingredient_pat = LazyPattern('|'.join(
+        [f'(?P<{k}>{v.replace("{p}", k + "_")})' for (k, v) in ingredient_forms.items()]))
 auto = False
 
-#class IngredientParser():
-#
-#    def __init__(self):
-#        amount_pat = r''
-#        unit_pat = r''
-#        product_pat = r'(?P<product>[\w\s-]*\w+)'
-#        note_pat = r'(?P<note>,\s+[\s\w]+|\([\w\s]+\))*'
-#        full_pat = amount_pat + r'\s+' + unit_pat + r's?\s*' + product_pat\
-#                + r'\s*' + note_pat
-#
-#        self.ingredient_pat = re.compile(pat)
-#
-#    def translate(self, ingredient):
-#        """Translate ingredient from a known, unparsable ingredient to a
-#        useful ingredient."""
-#        if 'cooking spray' == ingredient.lower():
-#            return '1 tbsp olive oil'
-#
-#        return ingredient
-#
-#    def parse_amount(self, string):
-#        """Parse a number from a string."""
-#        if ' to ' in string:
-#            amount = amount.split(' to ')[0].strip()
-#        elif '-' in amount:
-#            amount = amount.split('-')[0].strip()
-#
-#        # Handle integers, decimals, and fractions
-#        print(f'parse_amount(): {part}')
-#        try:
-#            return int(part)
-#        except ValueError:
-#            try:
-#                return float(part)
-#            except ValueError:
-#                try:
-#                    # Might be a fraction
-#                    parts = part.split(' ')
-#
-#                    if '/' in parts[0]:
-#                        whole = 0
-#                        fraction_parts = parts[0].split('/')
-#                    else:
-#                        whole = float(parts[0])
-#                        fraction_parts = parts[1].split('/')
-#
-#                    print(f'whole: {whole}')
-#                    print(f'fraction_parts: {fraction_parts}')
-#                    decimal = int(fraction_parts[0]) / int(fraction_parts[1])
-#                    return whole + decimal
-#                except Exception as e:
-#                    return None
-#
-#    def parse(self, ingredient):
-#        ingredient = translate(ingredient)
-#
-#        amatch = self.ingredient_pat.match(ingredient)
-#        if not amatch:
-#            return (None, None, None, None)
+class RecipeImportError(Exception):
+    """A recipe can't be imported without user assistance."""
+
+class IngredientParser():
+    """Parses ingredient lines into (productid, unitid, amount, note) against
+    the catalog of a GrocyApi.
+
+    The ingredient forms are tried by one precompiled pattern and nothing is
+    printed. Results are memoized per line and catalog version, since lines
+    like "1 cup sugar" occur thousands of times in a crawled corpus.
+
+    Benchmarks can pass a timings Counter, to which the seconds spent in each
+    stage of a parse that isn't memoized are added: match, parse, lookup and
+    fuzzy. forms then maps every parsed line to the ingredient form it
+    matched, or None."""
+
+    def __init__(self, grocy, maxsize=65536, timings=None):
+        self.grocy = grocy
+        self.timings = timings
+        self.forms = {}
+        self.lower_version = None
+        self.lower_products = {}
+        self.parse_cached = lru_cache(maxsize=maxsize)(self._parse)
+        self.guess_cached = lru_cache(maxsize=maxsize)(self._guess)
+        self.template_cached = lru_cache(maxsize=maxsize)(self._template)
+
+    def parse(self, ingredient):
+        """Parse a sanitized ingredient with the ingredient patterns."""
+        return self.parse_cached(ingredient, self.grocy.version)
+
+    def guess(self, ingredient):
+        """Parse a sanitized ingredient by looking for a unit in it."""
+        return self.guess_cached(ingredient, self.grocy.version)
+
+    def parse_many(self, ingredients, guess=False):
+        """Sanitize and parse every line of ingredients."""
+        parse = self.guess if guess else self.parse
+        return [parse(self.sanitize(x)) for x in ingredients]
+
+    @staticmethod
+    def sanitize(ingredient):
+        # Remove possible ($0.00)
+        ingredient = money_pat.sub('', ingredient).strip()
+
+        # Remove any extra characters
+        return junk_pat.sub('', ingredient)
+
+    @staticmethod
+    def translate(ingredient):
+        """Translate a known, unparsable ingredient to a useful one."""
+        if ingredient.lower().startswith('handful'):
+            return '1/2 cup ' + ingredient[7:].strip()
+
+        if ingredient.lower() == 'cooking spray':
+            return '1 tbsp olive oil'
+
+        return ingredient
+
+    @staticmethod
+    def parse_amount(part):
+        """Parse an integer, decimal, or fraction like "1 1/2"."""
+        try:
+            return int(part)
+        except ValueError:
+            pass
+
+        try:
+            return float(part)
+        except ValueError:
+            pass
+
+        try:
+            parts = part.split(' ')
+
+            if '/' in parts[0]:
+                whole = 0
+                fraction_parts = parts[0].split('/')
+            else:
+                whole = float(parts[0])
+                fraction_parts = parts[1].split('/')
+
+            return whole + int(fraction_parts[0]) / int(fraction_parts[1])
+        except (IndexError, ValueError, ZeroDivisionError):
+            return None
+
+    @staticmethod
+    def lower_bound(amount):
+        """First amount of a range like "1 to 2" or "1-2"."""
+        if ' to ' in amount:
+            return amount.split(' to ')[0].strip()
+        elif '-' in amount:
+            return amount.split('-')[0].strip()
+
+        return amount
+
+    def template(self, ingredient):
+        """(key, amount) of ingredient with its leading amount replaced by #,
+        for lines the amount of which is the leading one. Other lines are
+        their own key with an amount of 1."""
+        return self.template_cached(ingredient)
+
+    def _template(self, ingredient):
+        ingredient = ' '.join(self.sanitize(ingredient).lower().split())
+        if self.translate(ingredient) != ingredient:
+            return (ingredient, 1)
+
+        amatch = ingredient_pat.match(ingredient)
+        if not amatch or amatch.lastgroup != 'full':
+            return (ingredient, 1)
+
+        amount = self.parse_amount(self.lower_bound(amatch.group('full_amount')))
+        if not amount:
+            return (ingredient, 1)
+
+        return ('#' + ingredient[amatch.end('full_amount'):], amount)
+
+    def parse_unit(self, ingredient):
+        """(unit name, text of the unit in ingredient) of the first unit
+        mentioned in ingredient."""
+        amatch = unit_search_pat.search(ingredient.lower())
+        if not amatch:
+            return (None, None)
+
+        return (unit_nicknames[amatch[0]], amatch[0].strip())
+
+    def unit_id(self, unit, amount):
+        """(unitid, amount) of amount of the unit named unit, in a fallback
+        unit if Grocy doesn't define it."""
+        unitid = self.grocy.units.get(unit)
+        if unitid or unit not in unit_fallbacks or amount is None:
+            return (unitid, amount)
+
+        (unit, factor) = unit_fallbacks[unit]
+        return (self.grocy.units.get(unit), amount * factor)
+
+    def parse_product(self, text):
+        if self.lower_version != self.grocy.version:
+            self.lower_products = {x.name.lower(): x.id for x in self.grocy.products}
+            self.lower_version = self.grocy.version
+
+        productid = self.lower_products.get(text.lower())
+        if productid:
+            return productid
+
+        info = product_nicknames.get(text)
+        return self.grocy.productiddict.get(info[0]) if info else None
+
+    def _guess(self, ingredient, version):
+        amount = None
+        note = None
+        productid = None
+
+        (unit, unit_text) = self.parse_unit(ingredient)
+
+        if not unit:
+            return (None, None, None, None)
+
+        parts = ingredient.split(' ')
+        for idx in range(len(parts)):
+            if unit_text in parts[idx].lower():
+                amount = self.parse_amount(' '.join(parts[:idx]).strip())
+                productid = self.parse_product(' '.join(parts[idx+1:]).strip())
+                break
+
+        if not amount:
+            return (None, None, None, None)
+
+        (unitid, amount) = self.unit_id(unit, amount)
+        if not unitid:
+            return (None, None, None, None)
+
+        return (productid, unitid, amount, note)
+
+    def stopwatch(self):
+        """Function adding the seconds since it was last called to a stage of
+        timings, or doing nothing without timings."""
+        if self.timings is None:
+            return lambda stage: None
+
+        last = [perf_counter()]
+
+        def tick(stage):
+            now = perf_counter()
+            self.timings[stage] += now - last[0]
+            last[0] = now
+
+        return tick
+
+    def _parse(self, ingredient, version):
+        tick = self.stopwatch()
+        line = ingredient
+        ingredient = self.translate(ingredient)
+
+        amatch = ingredient_pat.match(ingredient)
+        tick('match')
+        if self.timings is not None:
+            self.forms[line] = amatch.lastgroup if amatch else None
+        if not amatch:
+            return (None, None, None, None)
+
+        # Group names are prefixed with the name of the form that matched
+        form = amatch.lastgroup
+        amount = amatch.group(f'{form}_amount')
+        unit = amatch.group(f'{form}_unit') or 'count'
+        product = amatch.group(f'{form}_product')
+        note = amatch.group(f'{form}_note')
+
+        amount = self.parse_amount(self.lower_bound(amount))
+
+        units = self.grocy.units
+        unitid = units.get(unit)
+        if not unitid:
+            unit = unit_nicknames.get(unit) if unit else unit
+            (unitid, amount) = self.unit_id(unit, amount)
+
+        notes = []
+        if note and note.startswith(', '):
+            notes = note[2:]
+
+        notes = [notes] if notes else []
+
+        # Sanitize product in case ingredient specifies prep in product name
+        parts = product.split(' ')
+        for idx in range(len(parts)):
+            verb_guess = ' '.join(parts[:idx])
+            if verb_guess in prep_verbs:
+                notes.append(verb_guess)
+                product = ' '.join(parts[idx:])
+                break
+
+        if product.lower().startswith('fresh'):
+            product = product[5:].strip()
+        tick('parse')
+
+        productid = self.grocy.productiddict.get(product)
+        if not productid:
+            info = product_nicknames.get(product)
+            product = info[0] if info else product
+            productid = self.grocy.productiddict.get(product)
+            if info and info[1]:
+                notes.append(info[1])
+
+        tick('lookup')
+
+        if not productid:
+            similars = self.grocy.index.similar(product, 0.7)
+            if similars:
+                productid = similars[0][1]
+            tick('fuzzy')
+
+        if product == 'garlic' and unit == 'count':
+            unit = 'teaspoon'
+            unitid = units.get(unit)
+
+        note = ', '.join(notes) if notes else None
+        tick('parse')
+
+        return (productid, unitid, amount, note)
+
+Product = namedtuple('Product', ['id', 'name'])
+
+def trigrams(text):
+    """Character trigrams of text, padded so that short names have some."""
+    text = f'  {text} '
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+class ProductIndex():
+    """Fuzzy product name lookup.
+
+    A trigram index narrows the catalog down to the names sharing the most
+    trigrams with the query, and only those are scored with SequenceMatcher.
+    Results are memoized per query until a product is added."""
+
+    # Names reranked with SequenceMatcher per query
+    candidates = 50
+
+    def __init__(self, products=()):
+        self.names = {}
+        self.grams = {}
+        self.index = defaultdict(set)
+        self.similar = lru_cache(maxsize=4096)(self._similar)
+        for product in products:
+            self.add(product)
+
+    def add(self, product):
+        name = product.name.lower()
+        grams = trigrams(name)
+        self.names[product.id] = product.name
+        self.grams[product.id] = len(grams)
+        for gram in grams:
+            self.index[gram].add(product.id)
+
+        self.similar.cache_clear()
+
+    def _similar(self, text, ratio):
+        text = text.lower()
+        grams = trigrams(text)
+
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.index.get(gram, ()))
+
+        # Dice coefficient of the trigram sets approximates the final ratio
+        dice = lambda x: 2 * shared[x] / (len(grams) + self.grams[x])
+        ret = []
+        for productid in nlargest(self.candidates, shared, key=dice):
+            name = self.names[productid]
+            similarity = SequenceMatcher(lambda y: y == ' ', text, name.lower()).ratio()
+            if similarity > ratio:
+                ret.append((name, productid, similarity))
+
+        ret.sort(key=lambda x: x[2], reverse=True)
+        return tuple(ret)
+
+class UnitConversions():
+    """Converts amounts between quantity units with the conversions defined
+    in Grocy.
+
+    Conversions are edges of a graph, and the factors between every pair of
+    units connected through any path are computed up front. A conversion
+    defined for a product takes precedence over the default ones. Factors are
+    memoized per (product, unit)."""
+
+    def __init__(self, conversions=(), stock_units=None):
+        # {from unit: {to unit: factor}} of the default and product conversions
+        self.default = defaultdict(dict)
+        self.product = defaultdict(lambda: defaultdict(dict))
+        for (from_unit, to_unit, factor, productid) in conversions:
+            if not factor:
+                continue
+
+            edges = self.product[productid] if productid else self.default
+            edges[from_unit][to_unit] = factor
+            # Grocy doesn't require the reverse conversion to be defined
+            edges[to_unit].setdefault(from_unit, 1 / factor)
+
+        self.stock_units = dict(stock_units or {})
+        self.closure = {x: self.paths(self.default, x) for x in list(self.default)}
+        self.factor = lru_cache(maxsize=16384)(self._factor)
+
+    @staticmethod
+    def paths(edges, start):
+        """{unit: factor} of every unit reachable from start."""
+        factors = {start: 1}
+        queue = [start]
+        for unit in queue:
+            for (to_unit, factor) in edges.get(unit, {}).items():
+                if to_unit not in factors:
+                    factors[to_unit] = factors[unit] * factor
+                    queue.append(to_unit)
+
+        return factors
+
+    def add_product(self, productid, unitid):
+        self.stock_units[productid] = unitid
+        self.factor.cache_clear()
+
+    def _factor(self, productid, unitid):
+        stock_unit = self.stock_units.get(productid)
+        if not stock_unit or stock_unit == unitid:
+            return 1 if stock_unit else None
+
+        overrides = self.product.get(productid)
+        if not overrides:
+            return self.closure.get(unitid, {}).get(stock_unit)
+
+        edges = {x: {**self.default.get(x, {}), **overrides.get(x, {})}
+                for x in set(self.default) | set(overrides)}
+        return self.paths(edges, unitid).get(stock_unit)
+
+    def to_stock(self, productid, unitid, amount):
+        """(unitid, amount) in the stock unit of the product, or unchanged if
+        there is no conversion to it."""
+        factor = self.factor(productid, unitid)
+        if factor is None or amount is None:
+            return (unitid, amount)
+
+        return (self.stock_units[productid], amount * factor)
+
+class Metrics():
+    """Counters, gauges and histograms of a run, written periodically as JSON
+    or, to a path ending in .prom, in the Prometheus textfile format.
+
+    Every metric has a name and optional labels, e.g.
+    metrics.observe('request_seconds', 0.3, host='example.com').
+
+    src/doit has its own copy, as each tool is shipped alone, without merging
+    the metrics of worker processes."""
+
+    # Upper bounds of the histogram buckets, in seconds
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.stopped = Event()
+        self.thread = None
+        self.path = None
+        # Functions setting gauges, called before every write
+        self.collectors = []
+
+    @staticmethod
+    def key(name, labels):
+        # Label values are compared when sorted, so they must all be strings
+        return (name, tuple(sorted([(k, str(v)) for (k, v) in labels.items()])))
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            hist = self.histograms[key]
+            for (idx, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][idx] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """Counters and histograms, for merge() in another process."""
+        with self.lock:
+            return (dict(self.counters), {x: [list(y[0]), y[1], y[2]] for (x, y) in self.histograms.items()})
+
+    def merge(self, snapshot):
+        (counters, histograms) = snapshot
+        with self.lock:
+            for (key, value) in counters.items():
+                self.counters[key] += value
+
+            for (key, (counts, total, count)) in histograms.items():
+                hist = self.histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                hist[0] = [x + y for (x, y) in zip(hist[0], counts)]
+                hist[1] += total
+                hist[2] += count
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def json(self):
+        with self.lock:
+            return {
+                'time': time(),
+                'counters': [{'name': self.prefix + n, 'labels': dict(l), 'value': v}
+                    for ((n, l), v) in self.counters.items()],
+                'gauges': [{'name': self.prefix + n, 'labels': dict(l), 'value': v}
+                    for ((n, l), v) in self.gauges.items()],
+                'histograms': [{'name': self.prefix + n, 'labels': dict(l),
+                        'buckets': dict(zip([str(x) for x in self.buckets], h[0])),
+                        'sum': h[1], 'count': h[2]}
+                    for ((n, l), h) in self.histograms.items()],
+            }
+
+    @staticmethod
+    def labelstr(labels):
+        if not labels:
+            return ''
+
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join([f'{k}="{escape(v)}"' for (k, v) in labels]) + '}'
+
+    def prometheus(self):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                lines.append(f'# TYPE {name} {kind}')
+                typed.add(name)
+
+        with self.lock:
+            for ((name, labels), value) in sorted(self.counters.items()):
+                declare(self.prefix + name, 'counter')
+                lines.append(f'{self.prefix}{name}{self.labelstr(labels)} {value}')
+
+            for ((name, labels), value) in sorted(self.gauges.items()):
+                declare(self.prefix + name, 'gauge')
+                lines.append(f'{self.prefix}{name}{self.labelstr(labels)} {value}')
+
+            for ((name, labels), (counts, total, count)) in sorted(self.histograms.items()):
+                name = self.prefix + name
+                declare(name, 'histogram')
+                for (bound, n) in zip(self.buckets + ('+Inf',), counts + [count]):
+                    le = self.labelstr(labels + (('le', bound),))
+                    lines.append(f'{name}_bucket{le} {n}')
+                lines.append(f'{name}_sum{self.labelstr(labels)} {total}')
+                lines.append(f'{name}_count{self.labelstr(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def collect(self, func):
+        self.collectors.append(func)
+
+    def write(self):
+        if not self.path:
+            return
+
+        for func in self.collectors:
+            func()
+
+        data = self.prometheus() if self.path.endswith('.prom') else json.dumps(self.json())
+        # Replaced atomically so that collectors never read half a file
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write(data)
+        replace(tmp, self.path)
+
+    def start(self, path, interval):
+        """Write the metrics to path every interval seconds until stop()."""
+        self.path = path
+
+        def run():
+            while not self.stopped.wait(interval):
+                self.write()
+
+        self.thread = Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+        self.write()
+
+metrics = Metrics('grocycli_')
+
+class GrocyError(Exception):
+    """Grocy answered a request with an error status."""
+
+    def __init__(self, code, body):
+        super().__init__(f'HTTP {code}: {body[:200]!r}')
+        self.code = code
+        self.body = body
+
+class ConnectionPool():
+    """Keep-alive connections to one HTTP(S) server, shared by threads.
+
+    Requests are retried with exponential backoff when the connection drops
+    and, for requests that are safe to repeat, on a 5xx response. A POST is
+    only resent when it failed on a reused connection the server had already
+    closed, so it can't be created twice."""
+
+    def __init__(self, url, port, timeout=30, retries=3, backoff=0.5, size=8):
+        parts = urlparse(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = int(port)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.idle = LifoQueue(maxsize=size)
+
+    def connect(self):
+        # Imported when first needed, as are the process and thread pools, so
+        # that commands which never talk to Grocy start quickly
+        from http.client import HTTPConnection, HTTPSConnection
+
+        cls = HTTPSConnection if self.https else HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers={}):
+        """Send a request and return (status, body)."""
+        from http.client import HTTPException
+
+        attempt = 0
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except Empty:
+                conn = self.connect()
+                reused = False
+
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                res = conn.getresponse()
+                data = res.read()
+            except (ConnectionError, HTTPException, TimeoutError) as e:
+                conn.close()
+                idempotent = method != 'POST' or (reused and isinstance(e, ConnectionError))
+                if attempt >= self.retries or not idempotent:
+                    raise
+
+                metrics.count('request_retries_total', reason=type(e).__name__)
+                sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+
+            if res.will_close or self.idle.full():
+                conn.close()
+            else:
+                self.idle.put_nowait(conn)
+
+            if res.status >= 500 and method != 'POST' and attempt < self.retries:
+                metrics.count('request_retries_total', reason=res.status)
+                sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+
+            return (res.status, data)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                return
 
 class GrocyApi():
+    """Client of the Grocy API. The product and unit catalog is loaded when
+    one of the attributes below is first used, so commands that never need
+    it don't wait for it."""
 
-    productiddict = None
-    products = None
-    units = None
+    # Attributes that load the catalog
+    catalog_attrs = {'products', 'productiddict', 'units', 'index', 'conversions', 'catalog',
+            'conversion_rows', 'changed_time', 'version'}
 
-    def __init__(self, url, api_key, port=80):
+    def __init__(self, url, api_key, port=80, timeout=30, retries=3, cache_dir=None, refresh=False):
         self.url = url
         self.port = port
         self.api_key = api_key
-        self.headers = {'GROCY-API-KEY': api_key}
-        self.grocy = Grocy(url, api_key, port=port)
+        self.headers = {'GROCY-API-KEY': api_key,
+                'accept': 'application/json',
+                'Content-Type': 'application/json',
+                }
+        self.pool = ConnectionPool(url, port, timeout=timeout, retries=retries)
 
-        self.products = self.all_products()
-        self.productiddict = {x.name: x.id for x in self.products}
-        self.units = {x.get('name'): x.get('id') for x in self.get_quantity_units()}
+        self.cache_file = None
+        if cache_dir:
+            self.cache_file = path.join(cache_dir, f'catalog-{self.cache_name()}.json')
 
-    def all_products(self):
-        return self.grocy.all_products()
+        self.refresh = refresh
+        self.loaded = False
 
-    def delete(self, url):
-        req = Request(url=url, headers=headers, method='DELETE')
-        with urlopen(req) as f:
-            ret = f.read().decode('utf-8')
-            return json.loads(ret if ret else '{}')
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set yet
+        if name not in self.catalog_attrs or self.loaded:
+            raise AttributeError(name)
 
-    def get(self, url):
-        req = Request(url=url, method='GET')
-        with urlopen(req) as f:
-            return json.loads(f.read().decode('utf-8'))
+        self.load()
+        return getattr(self, name)
 
-    def get_quantity_units(self):
-        return get(f'{self.url}:{self.port}/api/objects/quantity_units')
+    def load(self):
+        """Load the catalog unless it already is."""
+        if not self.loaded:
+            self.load_catalog(refresh=self.refresh)
+
+    def all_products(self, since=None):
+        endpoint = '/api/objects/products'
+        if since:
+            endpoint += '?query%5B%5D=' + quote(f'row_created_timestamp>={since}')
+
+        return [[x.get('id'), x.get('name'), x.get('row_created_timestamp'), x.get('qu_id_stock')]
+                for x in self.get(endpoint)]
+
+    def cache_name(self):
+        """Name of the files cached for this Grocy instance."""
+        return sha1(f'{self.url}:{self.port}'.encode('utf-8')).hexdigest()[:16]
+
+    def signature(self):
+        """Hash of the products, units and conversions."""
+        catalog = [sorted([x[0], x[1], x[3]] for x in self.catalog), sorted(self.units.items()),
+                sorted(self.conversion_rows, key=str)]
+        return sha1(json.dumps(catalog).encode('utf-8')).hexdigest()
+
+    def read_cache(self):
+        if not self.cache_file:
+            return None
 
-    def post(self, url, data):
-        data = json.dumps(data).encode('utf-8')
-        req = Request(url=url, headers=headers, data=data, method='POST')
         try:
-            with urlopen(req) as f:
-                return json.loads(f.read().decode('utf-8'))
-        except HTTPError as e:
-            print(e.code)
-            print(e.read())
-            raise e
+            with open(self.cache_file, 'r') as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        if cache.get('url') != f'{self.url}:{self.port}' or cache.get('format') != catalog_format:
+            return None
+
+        return cache
+
+    def write_cache(self):
+        if not self.cache_file:
+            return
+
+        cache = {
+                'url': f'{self.url}:{self.port}',
+                'format': catalog_format,
+                'changed_time': self.changed_time,
+                'products': self.catalog,
+                'units': self.units,
+                'conversions': self.conversion_rows,
+                }
+
+        makedirs(path.dirname(self.cache_file), exist_ok=True)
+        tmp = f'{self.cache_file}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(cache, fp)
+        replace(tmp, self.cache_file)
+
+    def load_catalog(self, refresh=False):
+        """Load the products and units from the cache, downloading only what
+        changed since it was written. Grocy only reports when its database
+        last changed, so products created since then are fetched, but renamed
+        or deleted products and changed stock units need refresh=True."""
+        if not self.loaded:
+            self.products = []
+            self.productiddict = {}
+            self.units = {}
+            # Changes whenever the catalog does
+            self.version = 0
+
+        cache = None if refresh else self.read_cache()
+        changed_time = self.get('/api/system/db-changed-time').get('changed_time')
+
+        if cache and cache.get('changed_time') == changed_time:
+            metrics.count('catalog_loads_total', source='cache')
+            catalog = cache['products']
+            units = cache['units']
+            conversions = cache['conversions']
+        elif cache:
+            metrics.count('catalog_loads_total', source='incremental')
+            created = [x[2] for x in cache['products'] if x[2]]
+            since = max(created) if created else None
+            catalog = {x[0]: x for x in cache['products']}
+            for product in self.all_products(since=since):
+                catalog[product[0]] = product
+            catalog = list(catalog.values())
+            units = {x.get('name'): x.get('id') for x in self.get_quantity_units()}
+            conversions = self.get_conversions()
+        else:
+            metrics.count('catalog_loads_total', source='full')
+            catalog = self.all_products()
+            units = {x.get('name'): x.get('id') for x in self.get_quantity_units()}
+            conversions = self.get_conversions()
+
+        # [id, name, row_created_timestamp, qu_id_stock] of every product, as
+        # cached
+        self.catalog = catalog
+        # [from_qu_id, to_qu_id, factor, product_id] of every unit conversion
+        self.conversion_rows = conversions
+        self.changed_time = changed_time
+
+        # Update in place so that references to them stay valid
+        self.products[:] = [Product(x[0], x[1]) for x in catalog]
+        self.index = ProductIndex(self.products)
+        self.productiddict.clear()
+        self.productiddict.update({x.name: x.id for x in self.products})
+        self.units.clear()
+        self.units.update(units)
+        self.conversions = UnitConversions(conversions, {x[0]: x[3] for x in catalog})
+        self.version += 1
+        self.loaded = True
+
+        self.write_cache()
+
+    def request(self, method, path, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        endpoint = id_pat.sub('/{id}', path.split('?')[0])
+        with metrics.timer('request_seconds', method=method, endpoint=endpoint):
+            (status, ret) = self.pool.request(method, path, body=body, headers=self.headers)
+
+        metrics.count('http_responses_total', status=status)
+        if status >= 400:
+            log.warning(f'{method} {path} failed with HTTP {status}: {ret[:200]!r}')
+            raise GrocyError(status, ret)
+
+        ret = ret.decode('utf-8')
+        return json.loads(ret if ret else '{}')
+
+    def delete(self, path):
+        return self.request('DELETE', path)
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def get_quantity_units(self):
+        return self.get('/api/objects/quantity_units')
+
+    def get_conversions(self):
+        return [[x.get('from_qu_id'), x.get('to_qu_id'), float(x.get('factor') or 0), x.get('product_id')]
+                for x in self.get('/api/objects/quantity_unit_conversions')]
+
+    def post(self, path, data):
+        return self.request('POST', path, data=data)
 
     def post_recipe(self, name, description, servings):
         data = {
@@ -212,7 +968,7 @@ class GrocyApi():
                 'desired_servings': servings,
                 }
 
-        res = self.post(f'{self.url}:{self.port}/api/objects/recipes', data=data)
+        res = self.post('/api/objects/recipes', data=data)
         return res.get('created_object_id')
 
     def post_product(self, name, unitid):
@@ -224,9 +980,20 @@ class GrocyApi():
                 'qu_id_purchase': unitid,
                 'qu_id_stock': unitid,
                 }
-        res = self.post(f'{self.url}:{self.port}/api/objects/products', data=data)
-        self.products = self.all_products()
-        return res.get('created_object_id')
+        res = self.post('/api/objects/products', data=data)
+        productid = res.get('created_object_id')
+
+        # The next run fetches it with the other products created since
+        product = Product(productid, name)
+        self.products.append(product)
+        self.index.add(product)
+        self.version += 1
+        self.productiddict[name] = productid
+        self.conversions.add_product(productid, unitid)
+        self.catalog.append([productid, name, None, unitid])
+        self.write_cache()
+
+        return productid
 
     def add_ingredient_to_recipe(self, recipeid, productid, unitid, amount, group_name=None, note=None, price_factor=1):
         data = {
@@ -240,16 +1007,194 @@ class GrocyApi():
                 'note': note,
                 }
 
-        res = self.post(f'{self.url}:{self.port}/api/objects/recipes_pos', data=data)
+        res = self.post('/api/objects/recipes_pos', data=data)
         return res.get('created_object_id')
 
     def delete_recipe(self, recipeid):
-        return self.delete(f'{self.url}:{self.port}/api/objects/recipes/{recipeid}')
-
-def get(url):
-    req = Request(url=url, headers=headers, method='GET')
-    with urlopen(req) as f:
-        return json.loads(f.read().decode('utf-8'))
+        return self.delete(f'/api/objects/recipes/{recipeid}')
+
+    def delete_recipe_pos(self, positionid):
+        return self.delete(f'/api/objects/recipes_pos/{positionid}')
+
+class ResolutionTable():
+    """Persistent map of ingredient text to (productid, unitid, amount factor,
+    note), shared by every import into one Grocy instance.
+
+    Keys are ingredient lines as normalized by IngredientParser.template(), so
+    "2 cups flour" and "3 cups flour" share a row and the amount is the
+    leading amount times the factor. Rows parsed automatically are dropped
+    whenever the catalog changes. Rows the user answered are kept, but are
+    only used while their product and unit exist."""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS resolutions (
+            text TEXT PRIMARY KEY,
+            productid INTEGER NOT NULL,
+            unitid INTEGER NOT NULL,
+            factor REAL NOT NULL,
+            note TEXT,
+            user INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, file, grocy):
+        self.file = file
+        self.grocy = grocy
+        self.conn = None
+        self.pid = None
+        self.ids_version = None
+        self.ids = (set(), set())
+        self.ready = False
+
+    def db(self):
+        # Forked workers can't use the connection of their parent
+        if self.pid != getpid():
+            if not self.ready:
+                self.prepare()
+            self.conn = sqlite3.connect(self.file, timeout=60)
+            self.pid = getpid()
+
+        return self.conn
+
+    def prepare(self):
+        """Create the table, dropping the parsed rows if the catalog changed.
+        Done on first use, as the catalog is needed to tell."""
+        makedirs(path.dirname(self.file) or '.', exist_ok=True)
+        db = sqlite3.connect(self.file, timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(self.schema)
+
+        signature = self.grocy.signature()
+        row = db.execute("SELECT value FROM meta WHERE key = 'catalog'").fetchone()
+        if not row or row[0] != signature:
+            with db:
+                db.execute('DELETE FROM resolutions WHERE user = 0')
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('catalog', ?)", (signature,))
+
+        db.close()
+        self.ready = True
+
+    def valid(self, productid, unitid):
+        if self.ids_version != self.grocy.version:
+            self.ids = (set(self.grocy.productiddict.values()), set(self.grocy.units.values()))
+            self.ids_version = self.grocy.version
+
+        return productid in self.ids[0] and unitid in self.ids[1]
+
+    def get(self, ingredient):
+        """(productid, unitid, amount, note) of ingredient, or None."""
+        (text, amount) = parser.template(ingredient)
+        row = self.db().execute(
+                'SELECT productid, unitid, factor, note FROM resolutions WHERE text = ?', (text,)).fetchone()
+        if not row or not self.valid(row[0], row[1]):
+            return None
+
+        return (row[0], row[1], amount * row[2], row[3])
+
+    def put_many(self, resolutions, user=False):
+        """Store (ingredient, (productid, unitid, amount, note)) pairs. Rows
+        parsed automatically never replace the answers of the user."""
+        rows = []
+        for (ingredient, (productid, unitid, amount, note)) in resolutions:
+            (text, lead) = parser.template(ingredient)
+            rows.append((text, productid, unitid, amount / lead, note, int(user)))
+
+        db = self.db()
+        with db:
+            db.executemany('''
+                    INSERT INTO resolutions (text, productid, unitid, factor, note, user)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (text) DO UPDATE SET productid = excluded.productid,
+                        unitid = excluded.unitid, factor = excluded.factor, note = excluded.note,
+                        user = excluded.user
+                    WHERE excluded.user >= resolutions.user''', rows)
+
+    def put(self, ingredient, resolution, user=False):
+        self.put_many([(ingredient, resolution)], user=user)
+
+class ImportJournal():
+    """Append-only log of the progress of an import, so that an interrupted
+    import resumes where it stopped.
+
+    Every line is a JSON object {"type": ..., "key": ..., "value": ...}:
+
+        parsed     key: source   value: parsed recipe, its groups as a list
+                                        of [name, ingredients]
+        ingredient key: line     value: (productid, unitid, amount, note)
+                                        answered by the user
+        product    key: name     value: id of the product created
+        recipe     key: source   value: id of the recipe created
+        position   key: source   value: [index of the ingredient, id]
+        rollback   key: source   the recipe and its positions were deleted
+        done       key: source   the recipe was uploaded completely"""
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = Lock()
+        self.parsed = {}
+        self.ingredients = {}
+        self.products = {}
+        self.recipes = {}
+        self.positions = defaultdict(dict)
+        self.done = set()
+
+        line = '\n'
+        try:
+            with open(file, 'r') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of an interrupted write
+                        continue
+
+                    self.apply(entry.get('type'), entry.get('key'), entry.get('value'))
+        except FileNotFoundError:
+            pass
+
+        makedirs(path.dirname(file) or '.', exist_ok=True)
+        self.fp = open(file, 'a')
+        if not line.endswith('\n'):
+            self.fp.write('\n')
+
+    def apply(self, kind, key, value):
+        if kind == 'parsed':
+            # Group names may be None, which JSON object keys can't be
+            self.parsed[key] = (*value[:3], dict(value[3]))
+        elif kind == 'ingredient':
+            self.ingredients[key] = value
+        elif kind == 'product':
+            self.products[key] = value
+        elif kind == 'recipe':
+            self.recipes[key] = value
+        elif kind == 'position':
+            self.positions[key][value[0]] = value[1]
+        elif kind == 'rollback':
+            self.recipes.pop(key, None)
+            self.positions.pop(key, None)
+        elif kind == 'done':
+            self.done.add(key)
+
+    def record(self, kind, key, value=None):
+        with self.lock:
+            self.apply(kind, key, value)
+            self.fp.write(json.dumps({'type': kind, 'key': key, 'value': value}) + '\n')
+            self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+    def clear(self):
+        """Forget the import once it completed."""
+        self.close()
+        try:
+            remove(self.file)
+        except FileNotFoundError:
+            pass
 
 def process_recipe(data):
     """Grocy treats recipes and ingredients as separate, linking products to the
@@ -289,7 +1234,7 @@ def process_recipe(data):
     except ValueError:
         print(f'Couldn\'t convert "{servings}" to integer.')
         if auto:
-            exit(1)
+            raise RecipeImportError(f'Couldn\'t convert servings "{servings}" to integer')
 
         while True:
             try:
@@ -301,18 +1246,8 @@ def process_recipe(data):
     return (name, description, servings)
 
 def get_similar_products(text, ratio=0.5):
-    ret = []
-    for x in grocy.products:
-        similarity = SequenceMatcher(
-                lambda y: y == ' ',
-                text.lower(),
-                x.name.lower()).ratio()
-
-        if similarity > ratio:
-            ret.append([x.name, x.id, similarity])
-
-    sorted(ret, key=lambda x: x[2])
-    return ret
+    """[name, id, similarity] of the products similar to text, best first."""
+    return [list(x) for x in grocy.index.similar(text, ratio)]
 
 def interactive_get_uint(msg='Enter a positive integer: '):
     ret = None
@@ -355,202 +1290,52 @@ def interactive_make_product(name=None):
     if not name:
         name = input('Enter product name: ').strip()
 
+    if journal and name in journal.products:
+        print(f'Using "{name}" created by an earlier run')
+        return journal.products[name]
+
     print('Select a default unit for this product')
     units = grocy.units
-    choices = [[x.get('name'), x.get('id')] for x in units]
+    choices = [[unit, unitid] for (unit, unitid) in units.items()]
     unitid = interactive_get_choice(choices, msg='Select a unit: ')
 
-    return grocy.post_product(name, unitid)
-
-def parse_unit(ingredient):
-    print(f'parse_unit {ingredient}')
-    guesses = [unit_nicknames[k] for k in unit_nicknames if k in ingredient.lower()]
-    unit_guess = guesses[0] if guesses else None
-
-    if unit_guess:
-        for unit in grocy.units:
-            if unit_guess == unit.get('name'):
-                print(f'Automatically parsed unit "{unit_guess}"')
-                return (unit.get('id'), unit.get('name'))
-
-    return (None, None)
-
-def parse_amount(part):
-    # Handle integers, decimals, and fractions
-    print(f'parse_amount(): {part}')
-    try:
-        return int(part)
-    except ValueError:
-        try:
-            return float(part)
-        except ValueError:
-            try:
-                # Might be a fraction
-                parts = part.split(' ')
-
-                if '/' in parts[0]:
-                    whole = 0
-                    fraction_parts = parts[0].split('/')
-                else:
-                    whole = float(parts[0])
-                    fraction_parts = parts[1].split('/')
-
-                print(f'whole: {whole}')
-                print(f'fraction_parts: {fraction_parts}')
-                decimal = int(fraction_parts[0]) / int(fraction_parts[1])
-                return whole + decimal
-            except Exception as e:
-                return None
-
-def sanitize_ingredient(ingredient):
-    # Remove possible ($0.00)
-    amatch = money_pat.search(ingredient)
-    if amatch:
-        ingredient = ingredient.replace(amatch[0], '').strip()
-        print(f'Removed {amatch[0]}')
-
-    # Remove any extra characters
-    ingredient = re.sub(r'[^\w\s\./]', '', ingredient)
-
-    return ingredient
-
-def parse_product(text):
-    print(f'Parsing product from "{text}"')
-    matches = [x.id for x in grocy.products if x.name.lower() == text.lower()]
-    if matches:
-        return matches[0] if matches else None
+    productid = grocy.post_product(name, unitid)
+    if journal:
+        journal.record('product', name, productid)
 
-    return product_nicknames.get(text)
+    return productid
 
-def guess_ingredient(ingredient):
-    amount = None
-    note = None
-    productid = None
-    unitid = None
-
-    (unitid, unit_text) = parse_unit(ingredient)
-
-    if not unitid:
-        return (None, None, None, None)
-
-    parts = ingredient.split(' ')
-    for idx in range(len(parts)):
-        if unit_text in parts[idx]:
-            part = ' '.join(parts[:idx]).strip()
-            amount = parse_amount(part)
-
-    if not amount:
-        return (None, None, None, None)
-
-    for idx in range(len(parts)):
-        if unit_text in parts[idx]:
-            part = ' '.join(parts[idx+1:]).strip()
-            productid = parse_product(part)
-            break
-
-    return (productid, unitid, amount, note)
-
-def parse_ingredient(ingredient):
-    print(f'Parsing {ingredient}')
-    if ingredient.lower().startswith('handful'):
-        ingredient = '1/2 cup ' + ingredient[7:].strip()
-
-    if ingredient.lower() == 'cooking spray':
-        ingredient = '1 tbsp olive oil'
-
-    amatch = can_pat2.match(ingredient)
-
-    if not amatch:
-        amatch = can_pat.match(ingredient)
-
-    if not amatch:
-        amatch = ingredient_pat.match(ingredient)
-
-    if not amatch:
-        return (None, None, None, None)
+def process_ingredient(ingredient):
+    log.debug(f'Processing: "{ingredient}"')
 
-    print(amatch.groups())
+    if not auto and journal and ingredient in journal.ingredients:
+        log.info(f'Using the answers of an earlier run for "{ingredient}"')
+        metrics.count('resolutions_total', source='journal')
+        return tuple(journal.ingredients[ingredient])
 
-    amount = amatch.group('amount')
-    unit = amatch.group('unit') or 'count'
-    product = amatch.group('product')
-    note = amatch.group('note')
+    resolved = resolutions.get(ingredient) if resolutions else None
+    if resolved:
+        metrics.count('resolutions_total', source='table')
+        return resolved
 
-    if ' to ' in amount:
-        amount = amount.split(' to ')[0].strip()
-    elif '-' in amount:
-        amount = amount.split('-')[0].strip()
+    line = ingredient
+    ingredient = parser.sanitize(ingredient)
 
-    amount = parse_amount(amount)
+    with metrics.timer('stage_seconds', stage='ingredient'):
+        if auto:
+            (productid, unitid, amount, note) = parser.parse(ingredient)
+        else:
+            (productid, unitid, amount, note) = parser.guess(ingredient)
 
-    unitid = grocy.units.get(unit)
-    if not unitid:
-        unit = unit_nicknames.get(unit) if unit else unit
-        unitid = grocy.units.get(unit)
-
-    notes = []
-    if note and note.startswith(', '):
-        notes = note[2:]
-
-    notes = [notes] if notes else []
-
-    # Sanitize product in case ingredient specifies prep in product name
-    parts = product.split(' ')
-    for idx in range(len(parts)):
-        verb_guess = ' '.join(parts[:idx])
-        if verb_guess in prep_verbs:
-            notes.append(verb_guess)
-            product = ' '.join(parts[idx:])
-            print('Found prep info in product name.')
-            print(f'product: {product}')
-            print(f'notes: {notes}')
-            break
-
-    if product.lower().startswith('fresh'):
-        product = product[5:].strip()
-
-    productid = grocy.productiddict.get(product)
-    if not productid:
-        info = product_nicknames.get(product)
-        product = info[0] if info else product
-        productid = grocy.productiddict.get(product)
-        if info and info[1]:
-            notes.append(info[1])
+    asked = not (productid and unitid and amount)
+    metrics.count('resolutions_total', source='user' if asked else 'parser')
 
     if not productid:
-        similars = get_similar_products(product, ratio=0.7)
-        if similars:
-            info = similars[0]
-            productid = info[1]
-            print(f'Similarity of best match "{info[0]}": {info[2]}')
-
-    if product == 'garlic' and unit == 'count':
-        unit = 'teaspoon'
-        unitid = grocy.units.get(unit)
-
-    note = ', '.join(notes) if notes else None
-
-    print(f'productid: {productid} ({product})')
-    print(f'amount: {amount}')
-    print(f'unitid: {unitid} ({unit})')
-    print(f'note: {note}')
-
-    return (productid, unitid, amount, note)
-
-def process_ingredient(ingredient):
-    print(f'Processing: "{ingredient}"')
-
-    ingredient = sanitize_ingredient(ingredient)
-
-    if auto:
-        (productid, unitid, amount, note) = parse_ingredient(ingredient)
-    else:
-        (productid, unitid, amount, note) = guess_ingredient(ingredient)
+        if auto:
+            metrics.count('resolutions_total', source='unresolved')
+            raise RecipeImportError(f'Could not parse product from "{ingredient}"')
 
-    if not productid:
         print(f'\nCould not parse product from "{ingredient}"')
-        if auto:
-            exit(1)
 
         print(f'What is the name of the ingredient in "{ingredient}"?')
         name = input(f'Name: ').strip()
@@ -565,43 +1350,127 @@ def process_ingredient(ingredient):
             productid = interactive_make_product(name)
 
     if not unitid:
-        print(f'\nCould not parse unit from "{ingredient}"')
         if auto:
-            exit(1)
+            metrics.count('resolutions_total', source='unresolved')
+            raise RecipeImportError(f'Could not parse unit from "{ingredient}"')
+
+        print(f'\nCould not parse unit from "{ingredient}"')
 
         print(f'What is the unit in "{ingredient}"?')
-        units = [[x.get('name'), x.get('id')] for x in grocy.units]
+        units = [[unit, unitid] for (unit, unitid) in grocy.units.items()]
         while not unitid:
             unitid = interactive_get_choice(units)
 
     if not amount:
-        print(f'\nCould not parse amount from "{ingredient}"')
         if auto:
-            exit(1)
+            metrics.count('resolutions_total', source='unresolved')
+            raise RecipeImportError(f'Could not parse amount from "{ingredient}"')
+
+        print(f'\nCould not parse amount from "{ingredient}"')
 
         print(f'What is the amount of the ingredient "{ingredient}"?')
         amount = interative_get_ufloat(msg='Enter amount: ')
 
+    (unitid, amount) = grocy.conversions.to_stock(productid, unitid, amount)
+
+    if not auto and journal:
+        journal.record('ingredient', line, [productid, unitid, amount, note])
+
+    # Parse workers in --auto mode leave the table to the resolve command
+    if not auto and resolutions:
+        resolutions.put(line, (productid, unitid, amount, note), user=asked)
+
     return (productid, unitid, amount, note)
 
-def add_recipe(args):
-    file = args.file
+def resolve_ingredients(ingredients):
+    """(ingredient, (productid, unitid, amount, note)) of every ingredient
+    that parses without user assistance."""
+    resolved = []
+    for (ingredient, (productid, unitid, amount, note)) in zip(ingredients, parser.parse_many(ingredients)):
+        if productid and unitid and amount:
+            (unitid, amount) = grocy.conversions.to_stock(productid, unitid, amount)
+            resolved.append((ingredient, (productid, unitid, amount, note)))
+
+    return resolved
+
+def recipe_ingredients(data):
+    lines = []
+    for group in (data or {}).get('ingredient_groups') or []:
+        lines += group.get('ingredients') or []
 
-    print(f'Adding recipe from file "{file}"')
+    return lines
 
-    data = None
-    with open(file, 'r') as fp:
-        data = json.load(fp)
+def load_recipe(file, key=None):
+    """Load a recipe from a JSON file, or the recipe with key from a recipe
+    store (recipes.db or the directory holding it)."""
+    if key is None:
+        with open(file, 'r') as fp:
+            return json.load(fp)
+
+    if path.isdir(file):
+        file = path.join(file, 'recipes.db')
+
+    db = sqlite3.connect(file)
+    try:
+        row = db.execute('SELECT data FROM recipes WHERE key = ?', (key,)).fetchone()
+    finally:
+        db.close()
+
+    return json.loads(row[0]) if row else None
+
+def recipe_sources(file, key=None):
+    """(file, key) of every recipe to import from file, which may be a JSON
+    file, a glob of JSON files, a directory of JSON files, or a recipe store."""
+    if key is not None:
+        return [(file, key)]
+
+    if path.isdir(file):
+        if path.exists(path.join(file, 'recipes.db')):
+            file = path.join(file, 'recipes.db')
+        else:
+            return [(x, None) for x in sorted(glob(path.join(file, '*.json')))]
+
+    if file.endswith('.db'):
+        db = sqlite3.connect(file)
+        try:
+            # Skip the recipes marked as near-duplicates of others, in stores
+            # that have fingerprints
+            query = 'SELECT key FROM recipes ORDER BY title'
+            if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'fingerprints'").fetchone():
+                query = ('SELECT key FROM recipes WHERE key NOT IN '
+                        '(SELECT key FROM fingerprints WHERE duplicate_of IS NOT NULL) ORDER BY title')
+            keys = db.execute(query).fetchall()
+        finally:
+            db.close()
+
+        return [(file, x[0]) for x in keys]
+
+    if has_magic(file):
+        return [(x, None) for x in sorted(glob(file))]
+
+    return [(file, None)]
+
+def source_name(source):
+    (file, key) = source
+    return f'{file}:{key}' if key else file
+
+def parse_recipe(source):
+    """Parse the recipe of source into (name, description, servings,
+    {group name: [(productid, unitid, amount, note)]})."""
+    log.info(f'Adding recipe from "{source_name(source)}"')
+
+    data = load_recipe(*source)
+    if not data:
+        raise RecipeImportError('Recipe not found')
 
     (recipe_name, description, servings) = process_recipe(data)
 
     groups = data.get('ingredient_groups')
     if not groups:
-        print('No ingredients found. Nothing to upload.')
-        exit(1)
+        raise RecipeImportError('No ingredients found. Nothing to upload.')
 
     ingredient_groups = {}
-    for group in data.get('ingredient_groups'):
+    for group in groups:
         group_name = group.get('purpose')
 
         ingredients = group.get('ingredients')
@@ -611,48 +1480,308 @@ def add_recipe(args):
 
         ingredient_groups[group_name] = info
 
-    print(f'Uploading recipe "{recipe_name}"')
-    recipeid = grocy.post_recipe(recipe_name, description=description, servings=servings)
-    for group in ingredient_groups:
-        for (productid, unitid, amount, note) in ingredient_groups[group]:
-            print(f'Uploading ingredient "{productid}"')
+    return (recipe_name, description, servings, ingredient_groups)
+
+def try_parse_recipe(source):
+    """parse_recipe() for worker processes. Returns (recipe, error)."""
+    try:
+        with metrics.timer('stage_seconds', stage='parse'):
+            recipe = parse_recipe(source)
+        metrics.count('recipes_parsed_total', result='ok')
+        return (recipe, None)
+    except Exception as e:
+        metrics.count('recipes_parsed_total', result='error')
+        return (None, str(e) or type(e).__name__)
+
+def parse_in_worker(source):
+    """try_parse_recipe() and the metrics it recorded in this process."""
+    metrics.clear()
+    return (try_parse_recipe(source), metrics.snapshot())
+
+def rollback_recipe(recipeid, positionids, pool):
+    """Delete a partially uploaded recipe and the positions created for it."""
+    failed = 0
+    for future in [pool.submit(grocy.delete_recipe_pos, x) for x in positionids]:
+        try:
+            future.result()
+        except Exception:
+            failed += 1
+
+    grocy.delete_recipe(recipeid)
+    if failed:
+        log.error(f'Could not delete {failed} ingredients of recipe {recipeid}')
+
+def upload_position(key, index, recipeid, productid, unitid, amount, group_name, note):
+    positionid = grocy.add_ingredient_to_recipe(recipeid, productid, unitid, amount, group_name, note=note)
+    journal.record('position', key, [index, positionid])
+    return positionid
+
+def upload_recipe(source, recipe, pool):
+    """Upload a recipe, posting its ingredients concurrently through pool. If
+    any ingredient fails, everything created for the recipe is deleted.
+
+    A recipe partially uploaded by an interrupted run gets only its missing
+    ingredients."""
+    with metrics.timer('stage_seconds', stage='upload'):
+        try:
+            _upload_recipe(source, recipe, pool)
+        except Exception:
+            metrics.count('recipes_uploaded_total', result='error')
+            raise
+
+    metrics.count('recipes_uploaded_total', result='ok')
+
+def _upload_recipe(source, recipe, pool):
+    from concurrent.futures import FIRST_EXCEPTION, wait
+
+    (recipe_name, description, servings, ingredient_groups) = recipe
+    key = source_name(source)
+
+    recipeid = journal.recipes.get(key)
+    if recipeid:
+        log.info(f'Resuming upload of recipe "{recipe_name}"')
+    else:
+        log.info(f'Uploading recipe "{recipe_name}"')
+        recipeid = grocy.post_recipe(recipe_name, description=description, servings=servings)
+        journal.record('recipe', key, recipeid)
+
+    uploaded = journal.positions.get(key, {})
+    positions = [(group_name, x) for (group_name, ingredients) in ingredient_groups.items() for x in ingredients]
+    futures = []
+    for (index, (group_name, (productid, unitid, amount, note))) in enumerate(positions):
+        if index in uploaded:
+            continue
+
+        futures.append(pool.submit(upload_position, key, index, recipeid, productid, unitid, amount,
+                group_name, note))
+
+    (done, pending) = wait(futures, return_when=FIRST_EXCEPTION)
+    errors = [x.exception() for x in done if x.exception()]
+    if errors:
+        for future in pending:
+            future.cancel()
+        wait(pending)
+
+        log.warning(f'Failed to add an ingredient of "{recipe_name}". Deleting incomplete recipe.')
+        try:
+            rollback_recipe(recipeid, list(journal.positions.get(key, {}).values()), pool)
+        finally:
+            journal.record('rollback', key)
+        raise RecipeImportError(f'Failed to add ingredient: {errors[0]}')
+
+    journal.record('done', key)
+    log.info(f'Uploaded "{recipe_name}" successfully.')
+
+def prepare_workers():
+    """Load the catalog and resolution table before forking, so that workers
+    share them instead of each loading them again."""
+    grocy.load()
+    resolutions.db()
+    ingredient_pat.match('')
+    unit_search_pat.search('')
+
+def fork_workers(jobs):
+    """Start a pool of jobs worker processes. They are forked so that they
+    share the catalog loaded by this process, and have to be forked before
+    any thread starts: a child inheriting a lock held by another thread
+    would wait for it forever."""
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    prepare_workers()
+    context = multiprocessing.get_context('fork')
+    pool = ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+    # Forked workers are all started by the first task
+    pool.submit(int).result()
+    return pool
+
+def start_metrics(args):
+    """Start writing metrics, once the workers are forked."""
+    if args.metrics:
+        metrics.start(args.metrics, args.metrics_interval)
+
+def parse_recipes(sources, workers=None):
+    """Parse every source, in the worker processes if given. Yields (source,
+    recipe, error) in order."""
+    if not workers:
+        for source in sources:
+            yield (source, *try_parse_recipe(source))
+        return
+
+    for (source, (result, snapshot)) in zip(sources, workers.map(parse_in_worker, sources, chunksize=4)):
+        metrics.merge(snapshot)
+        yield (source, *result)
+
+def journal_file(args):
+    """Journal of importing args.file into the Grocy instance."""
+    name = f'{url}:{port}:{path.abspath(args.file)}:{args.key}'
+    return path.join(cache_dir, f'journal-{sha1(name.encode("utf-8")).hexdigest()[:16]}.jsonl')
+
+def add_recipe(args):
+    global journal
+    from concurrent.futures import ThreadPoolExecutor
+
+    sources = recipe_sources(args.file, args.key)
+    if not sources:
+        log.error(f'No recipes found in "{args.file}"')
+        exit(1)
+
+    file = journal_file(args)
+    if args.restart and path.exists(file):
+        remove(file)
+    journal = ImportJournal(file)
+
+    failed = []
+    uploaded = len([x for x in sources if source_name(x) in journal.done])
+    if uploaded:
+        log.info(f'Skipping {uploaded} recipes imported by an earlier run')
+        metrics.count('recipes_skipped_total', uploaded)
+
+    todo = [x for x in sources if source_name(x) not in journal.done]
+    parsed = [(x, journal.parsed[source_name(x)], None) for x in todo if source_name(x) in journal.parsed]
+    unparsed = [x for x in todo if source_name(x) not in journal.parsed]
+
+    workers = fork_workers(args.jobs) if auto and args.jobs > 1 and len(unparsed) > 1 else None
+    start_metrics(args)
+
+    with ThreadPoolExecutor(max_workers=args.positions) as positions, \
+            ThreadPoolExecutor(max_workers=args.uploads) as pool:
+        uploads = {}
+
+        def collect():
+            metrics.gauge('uploads_pending', len([x for x in list(uploads.values()) if not x.done()]))
+            info = parser.parse_cached.cache_info()
+            metrics.gauge('parser_cache_hits', info.hits)
+            metrics.gauge('parser_cache_misses', info.misses)
+        metrics.collect(collect)
+
+        for (source, recipe, error) in chain(parsed, parse_recipes(unparsed, workers)):
+            if error:
+                log.warning(f'{source_name(source)}: {error}')
+                failed.append((source, error))
+                continue
+
+            if source_name(source) not in journal.parsed:
+                journal.record('parsed', source_name(source), [*recipe[:3], list(recipe[3].items())])
+
+            uploads[source] = pool.submit(upload_recipe, source, recipe, positions)
+
+        for (source, future) in uploads.items():
             try:
-                grocy.add_ingredient_to_recipe(recipeid, productid, unitid, amount, group_name, note=note)
-            except Exception:
-                print('Error: Failed to add ingredient. Deleting incomplete recipe.')
-                grocy.delete_recipe(recipeid)
-                exit(1)
+                future.result()
+                uploaded += 1
+            except Exception as e:
+                failed.append((source, str(e) or type(e).__name__))
 
-    print('Uploaded successfully.')
+    if workers:
+        workers.shutdown()
+
+    if len(sources) > 1:
+        log.info(f'Imported {uploaded} of {len(sources)} recipes.')
+        for (source, error) in failed:
+            log.warning(f'Failed: {source_name(source)}: {error}')
+
+    if failed:
+        journal.close()
+        exit(1)
 
+    journal.clear()
+
+
+def resolve_recipes(args):
+    """Fill the resolution table with every ingredient of the recipes that
+    parses without user assistance."""
+    sources = recipe_sources(args.file)
+    if not sources:
+        log.error(f'No recipes found in "{args.file}"')
+        exit(1)
+
+    ingredients = set()
+    for source in sources:
+        ingredients.update(recipe_ingredients(load_recipe(*source)))
+
+    ingredients = sorted(ingredients)
+    log.info(f'Resolving {len(ingredients)} distinct ingredients of {len(sources)} recipes')
+
+    if args.jobs < 2:
+        start_metrics(args)
+        resolved = resolve_ingredients(ingredients)
+    else:
+        with fork_workers(args.jobs) as pool:
+            start_metrics(args)
+            batches = [ingredients[i:i + 256] for i in range(0, len(ingredients), 256)]
+            resolved = list(chain.from_iterable(pool.map(resolve_ingredients, batches)))
+
+    resolutions.put_many(resolved)
+    log.info(f'Resolved {len(resolved)} of {len(ingredients)} ingredients')
 
 def parseargs():
     parser = ArgumentParser(description='A CLI interface for Grocy.')
+    refreshhelp = 'Download the whole product and unit catalog instead of using the cache.'
+    parser.add_argument('--refresh-catalog', action='store_true', default=False, help=refreshhelp)
+    loglevelhelp = 'Least severe messages to log. Default: info'
+    parser.add_argument('--log-level', type=str, default='info', choices=['debug', 'info', 'warning', 'error'],
+            help=loglevelhelp)
+    quiethelp = 'Only log warnings and errors. Questions are still asked.'
+    parser.add_argument('-q', '--quiet', action='store_true', default=False, help=quiethelp)
+    metricshelp = ('Write metrics to this file periodically, in the Prometheus textfile format if it ends '
+            'in .prom and as JSON otherwise.')
+    parser.add_argument('--metrics', type=str, help=metricshelp)
+    intervalhelp = f'Seconds between metrics writes. Default: {metrics_interval}'
+    parser.add_argument('--metrics-interval', type=float, default=metrics_interval, help=intervalhelp)
     subparsers = parser.add_subparsers(required=True)
 
     padd = subparsers.add_parser('add', help='Add an entity.')
 
     paddsp = padd.add_subparsers(required=True)
     paddrecipe = paddsp.add_parser('recipe', help='Add a recipe.')
-    paddrecipe.add_argument('file', type=str, help='File with entity to add.')
-    autohelp = 'Try to import a recipe without user assistance. Exits on first issue.'
+    filehelp = 'JSON file, glob or directory of JSON files, or recipe store with recipes to add.'
+    paddrecipe.add_argument('file', type=str, help=filehelp)
+    keyhelp = 'Key of the recipe to add when file is a recipe store.'
+    paddrecipe.add_argument('--key', type=str, help=keyhelp)
+    autohelp = 'Try to import recipes without user assistance. Skips recipes with issues.'
     paddrecipe.add_argument('--auto', action='store_true', default=False, help=autohelp)
+    jobshelp = 'Number of processes parsing recipes in --auto mode.'
+    paddrecipe.add_argument('--jobs', type=int, default=cpu_count() or 1, help=jobshelp)
+    uploadshelp = 'Number of recipes uploaded at the same time.'
+    paddrecipe.add_argument('--uploads', type=int, default=4, help=uploadshelp)
+    positionshelp = 'Number of ingredients uploaded at the same time, across all recipes.'
+    paddrecipe.add_argument('--positions', type=int, default=8, help=positionshelp)
+    restarthelp = 'Start over instead of resuming an interrupted import of file.'
+    paddrecipe.add_argument('--restart', action='store_true', default=False, help=restarthelp)
     paddrecipe.set_defaults(func=add_recipe)
 
+    presolve = subparsers.add_parser('resolve',
+            help='Resolve the ingredients of many recipes ahead of importing them.')
+    filehelp = 'JSON file, glob or directory of JSON files, or recipe store with recipes to resolve.'
+    presolve.add_argument('file', type=str, help=filehelp)
+    jobshelp = 'Number of processes parsing ingredients.'
+    presolve.add_argument('--jobs', type=int, default=cpu_count() or 1, help=jobshelp)
+    presolve.set_defaults(func=resolve_recipes, auto=True)
+
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parseargs()
 
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+            level=logging.WARNING if args.quiet else getattr(logging, args.log_level.upper()))
+
     if not api_key:
-        print('Grocy API key not defined.')
+        log.error('Grocy API key not defined.')
         exit(1)
 
     if not url:
-        print('Grocy URL not provided.')
+        log.error('Grocy URL not provided.')
         exit(1)
 
-    grocy = GrocyApi(url, api_key, port=port)
+    grocy = GrocyApi(url, api_key, port=port, timeout=timeout, retries=retries,
+            cache_dir=cache_dir, refresh=args.refresh_catalog)
+    parser = IngredientParser(grocy)
+    resolutions = ResolutionTable(path.join(cache_dir, f'resolutions-{grocy.cache_name()}.db'), grocy)
     auto = args.auto
 
-    args.func(args)
+    try:
+        args.func(args)
+    finally:
+        metrics.stop()
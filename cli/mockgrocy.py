@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""A stand-in for the parts of the Grocy API grocycli.py uses, so imports can
+be measured without a Grocy instance.
+
+The catalog is generated from a seed, objects created through the API are
+kept in memory, and every response can be delayed or turned into a 500 to
+mimic a remote or flaky Grocy. GET /mock/stats reports the requests served
+so far and POST /mock/reset clears those statistics."""
+
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+from threading import Lock
+from time import monotonic, sleep, strftime
+from urllib.parse import parse_qs, urlparse
+
+units = [
+        'count',
+        'cup',
+        'fluid ounce',
+        'gallon',
+        'gram',
+        'liter',
+        'milliliter',
+        'ounce',
+        'pound',
+        'quart',
+        'tablespoon',
+        'teaspoon',
+        ]
+
+# [from, to, factor] of the default conversions
+conversions = [
+        ['cup', 'tablespoon', 16],
+        ['fluid ounce', 'tablespoon', 2],
+        ['gallon', 'quart', 4],
+        ['liter', 'milliliter', 1000],
+        ['pound', 'ounce', 16],
+        ['quart', 'cup', 4],
+        ['tablespoon', 'teaspoon', 3],
+        ]
+
+ingredients = [
+        'almond', 'apple', 'bacon', 'baking powder', 'baking soda', 'basil',
+        'bean', 'beef', 'bread', 'broccoli', 'butter', 'carrot', 'celery',
+        'cheddar', 'chicken', 'chili powder', 'cinnamon', 'cocoa', 'corn',
+        'cream', 'cumin', 'egg', 'flour', 'garlic', 'ginger', 'honey', 'lemon',
+        'lime', 'milk', 'mushroom', 'oat', 'olive oil', 'onion', 'oregano',
+        'paprika', 'parsley', 'pasta', 'pepper', 'potato', 'rice', 'salt',
+        'spinach', 'sugar', 'thyme', 'tomato', 'vanilla', 'vinegar', 'yogurt',
+        ]
+
+varieties = [
+        'brown', 'dried', 'frozen', 'green', 'ground', 'organic', 'red', 'smoked',
+        'sweet', 'white', 'whole', 'wild', 'yellow',
+        ]
+
+objects_pat = re.compile(r'/api/objects/(?P<entity>\w+)(?:/(?P<id>\d+))?$')
+query_pat = re.compile(r'(?P<field>\w+)(?P<op>>=|<=|=|>|<)(?P<value>.*)')
+
+def product_names(count):
+    """count distinct product names, the plain ingredients first."""
+    names = list(ingredients)
+    names += [f'{x} {y}' for x in varieties for y in ingredients]
+    if count > len(names):
+        names += [f'product {x}' for x in range(count - len(names))]
+
+    return names[:count]
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class MockGrocy():
+    """Catalog, created objects and request statistics of the mock."""
+
+    def __init__(self, products=1000, latency=0, jitter=0, error_rate=0, seed=0):
+        self.lock = Lock()
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.next_id = 1
+        self.changed_time = self.now()
+
+        self.objects = {x: {} for x in ('products', 'quantity_units', 'quantity_unit_conversions',
+                'recipes', 'recipes_pos')}
+
+        unitids = {}
+        for name in units:
+            unitids[name] = self.create('quantity_units', {'name': name})
+
+        for (from_unit, to_unit, factor) in conversions:
+            self.create('quantity_unit_conversions', {'from_qu_id': unitids[from_unit],
+                    'to_qu_id': unitids[to_unit], 'factor': factor, 'product_id': None})
+
+        stock_units = [unitids[x] for x in ('count', 'gram', 'milliliter', 'teaspoon')]
+        for name in product_names(products):
+            unitid = self.random.choice(stock_units)
+            self.create('products', {'name': name, 'location_id': 1, 'qu_id_stock': unitid,
+                    'qu_id_purchase': unitid, 'qu_id_consume': unitid, 'qu_id_price': unitid})
+
+        self.reset()
+
+    @staticmethod
+    def now():
+        return strftime('%Y-%m-%d %H:%M:%S')
+
+    def create(self, entity, data):
+        objectid = self.next_id
+        self.next_id += 1
+        self.objects[entity][objectid] = {**data, 'id': objectid, 'row_created_timestamp': self.now()}
+        self.changed_time = self.now()
+        return objectid
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter()
+            self.latencies = []
+            self.errors = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'requests': dict(self.requests),
+                    'total': sum(self.requests.values()),
+                    'errors': self.errors,
+                    'latency_ms': {
+                        'p50': percentile(self.latencies, 0.5),
+                        'p99': percentile(self.latencies, 0.99),
+                        },
+                    'objects': {x: len(y) for (x, y) in self.objects.items()},
+                    }
+
+    def handle(self, method, url, body):
+        """(status, response JSON or None) of a request."""
+        start = monotonic()
+
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            sleep(delay)
+
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                (status, data) = (500, {'error_message': 'Injected error'})
+                self.errors += 1
+            else:
+                (status, data) = self.route(method, url, body)
+
+            path = objects_pat.sub(lambda m: f'/api/objects/{m["entity"]}' + ('/{id}' if m['id'] else ''),
+                    url.path)
+            self.requests[f'{method} {path}'] += 1
+            self.latencies.append((monotonic() - start) * 1000)
+
+        return (status, data)
+
+    def route(self, method, url, body):
+        if url.path == '/api/system/db-changed-time' and method == 'GET':
+            return (200, {'changed_time': self.changed_time})
+
+        amatch = objects_pat.match(url.path)
+        if not amatch or amatch['entity'] not in self.objects:
+            return (404, {'error_message': 'Not found'})
+
+        entity = amatch['entity']
+        objects = self.objects[entity]
+        objectid = int(amatch['id']) if amatch['id'] else None
+
+        if method == 'GET' and objectid is None:
+            rows = list(objects.values())
+            for query in parse_qs(url.query).get('query[]', []):
+                qmatch = query_pat.match(query)
+                if not qmatch:
+                    return (400, {'error_message': f'Invalid query {query}'})
+                rows = [x for x in rows if self.compare(x.get(qmatch['field']), qmatch['op'], qmatch['value'])]
+            return (200, rows)
+
+        if method == 'GET':
+            return (200, objects[objectid]) if objectid in objects else (404, None)
+
+        if method == 'POST' and objectid is None:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return (400, {'error_message': 'Invalid JSON'})
+            return (200, {'created_object_id': self.create(entity, data)})
+
+        if method == 'DELETE' and objectid is not None:
+            if objects.pop(objectid, None) is None:
+                return (404, {'error_message': 'Not found'})
+            self.changed_time = self.now()
+            return (204, None)
+
+        return (405, {'error_message': 'Method not allowed'})
+
+    @staticmethod
+    def compare(value, op, other):
+        value = '' if value is None else str(value)
+        return {'>=': value >= other, '<=': value <= other, '=': value == other, '>': value > other,
+                '<': value < other}[op]
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would
+    # hold back until the client's delayed ACK
+    disable_nagle_algorithm = True
+    grocy = None
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+    def route(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if url.path == '/mock/stats':
+            self.send_json(200, self.grocy.stats())
+        elif url.path == '/mock/reset' and method == 'POST':
+            self.grocy.reset()
+            self.send_json(204, None)
+        else:
+            self.send_json(*self.grocy.handle(method, url, body))
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(grocy, port=0):
+    """A server of grocy on port, 0 for any free port. Call serve_forever()
+    on it."""
+    handler = type('Handler', (Handler,), {'grocy': grocy})
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+def parseargs():
+    parser = ArgumentParser(description='A stand-in Grocy server for benchmarking grocycli.py.')
+    parser.add_argument('--port', type=int, default=9283, help='Port to listen on')
+    parser.add_argument('--products', type=int, default=1000, help='Number of products in the catalog')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='Up to this many more random seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with a 500')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the catalog and injected errors')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parseargs()
+    grocy = MockGrocy(products=args.products, latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, seed=args.seed)
+
+    with serve(grocy, args.port) as server:
+        print(f'Serving a mock Grocy with {args.products} products on port {server.server_address[1]}')
+        server.serve_forever()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""Measure the ingredient parser of grocycli.py over a crawled corpus.
+
+Every ingredient line of the corpus is parsed as 'add recipe --auto' would,
+against a fixed catalog: the one of mockgrocy.py, or a catalog cached by
+grocycli.py from a real Grocy with --catalog. Reports lines/s, the time spent
+in each stage, how often each ingredient form matches, how often the fuzzy
+product match is needed, and how many lines stay unresolved.
+
+--save writes the results as a baseline, and --baseline compares against one
+and exits with 1 when lines/s or the resolved rate regressed, e.g.
+
+    cli/parserbench.py recipes --save baseline.json
+    cli/parserbench.py recipes --baseline baseline.json"""
+
+from argparse import ArgumentParser
+from collections import Counter
+import json
+import sys
+from time import perf_counter
+
+import grocycli
+from mockgrocy import MockGrocy
+
+# match, parse, lookup and fuzzy are timed by IngredientParser, only when a
+# line isn't memoized
+stages = ['load', 'sanitize', 'match', 'parse', 'lookup', 'fuzzy', 'convert']
+
+
+class Catalog():
+    """The parts of GrocyApi the parser uses, loaded without a Grocy."""
+
+    def __init__(self, rows, units, conversions):
+        self.version = 1
+        self.products = [grocycli.Product(x[0], x[1]) for x in rows]
+        self.productiddict = {x.name: x.id for x in self.products}
+        self.units = units
+        self.index = grocycli.ProductIndex(self.products)
+        self.conversions = grocycli.UnitConversions(conversions, {x[0]: x[3] for x in rows})
+
+    @classmethod
+    def from_cache(cls, file):
+        with open(file, 'r') as fp:
+            cache = json.load(fp)
+
+        return cls(cache['products'], cache['units'], cache['conversions'])
+
+    @classmethod
+    def from_mock(cls, products):
+        objects = MockGrocy(products=products).objects
+        rows = [[x['id'], x['name'], None, x['qu_id_stock']] for x in objects['products'].values()]
+        units = {x['name']: x['id'] for x in objects['quantity_units'].values()}
+        conversions = [[x['from_qu_id'], x['to_qu_id'], x['factor'], x['product_id']]
+                for x in objects['quantity_unit_conversions'].values()]
+        return cls(rows, units, conversions)
+
+
+class Calls():
+    """Counts the calls of a function."""
+
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.func(*args, **kwargs)
+
+def corpus_lines(file, limit=None):
+    lines = []
+    for source in grocycli.recipe_sources(file):
+        lines += grocycli.recipe_ingredients(grocycli.load_recipe(*source))
+        if limit and len(lines) >= limit:
+            return lines[:limit]
+
+    return lines
+
+def run(lines, catalog, memoize):
+    timings = Counter()
+    forms = Counter()
+    unresolved = Counter()
+
+    fuzzy = Calls(catalog.index.similar)
+    catalog.index.similar = fuzzy
+    parser = grocycli.IngredientParser(catalog, maxsize=None if memoize else 0, timings=timings)
+
+    start = perf_counter()
+    parsed = parser.parse_many(lines)
+    converting = perf_counter()
+    for (productid, unitid, amount, note) in parsed:
+        if productid and unitid and amount:
+            catalog.conversions.to_stock(productid, unitid, amount)
+    seconds = perf_counter() - start
+    timings['convert'] = start + seconds - converting
+
+    # parse_many sanitizes each line before parsing it, so sanitizing is
+    # timed in a pass of its own
+    sanitizing = perf_counter()
+    texts = [parser.sanitize(x) for x in lines]
+    timings['sanitize'] = perf_counter() - sanitizing
+
+    for (text, (productid, unitid, amount, note)) in zip(texts, parsed):
+        forms[parser.forms.get(text) or 'none'] += 1
+        if not productid:
+            unresolved['product'] += 1
+        if not unitid:
+            unresolved['unit'] += 1
+        if not amount:
+            unresolved['amount'] += 1
+        if not (productid and unitid and amount):
+            unresolved['any'] += 1
+
+    count = len(lines) or 1
+    return {
+            'lines': len(lines),
+            'distinct_lines': len(set(lines)),
+            'memoized': memoize,
+            'seconds': round(seconds, 4),
+            'lines_per_second': round(len(lines) / seconds, 1) if seconds else None,
+            'stage_us_per_line': {x: round(timings[x] / count * 1e6, 2) for x in stages if x in timings},
+            'form_rate': {x: round(forms[x] / count, 4) for x in ('can2', 'can', 'full', 'none')},
+            'fuzzy_rate': round(fuzzy.calls / count, 4),
+            'unresolved_rate': {x: round(unresolved[x] / count, 4) for x in ('product', 'unit', 'amount', 'any')},
+            }
+
+def report(results):
+    print(f'{results["lines"]} lines ({results["distinct_lines"]} distinct) in {results["seconds"]}s: '
+            f'{results["lines_per_second"]} lines/s{"" if results["memoized"] else ", not memoized"}')
+    print('Microseconds per line:')
+    for (stage, us) in results['stage_us_per_line'].items():
+        print(f'  {stage:10} {us:10.2f}')
+    print('Ingredient forms matched:')
+    for (form, rate) in results['form_rate'].items():
+        print(f'  {form:10} {rate:10.2%}')
+    print(f'Fuzzy product matches: {results["fuzzy_rate"]:.2%}')
+    print('Unresolved:')
+    for (part, rate) in results['unresolved_rate'].items():
+        print(f'  {part:10} {rate:10.2%}')
+
+def compare(results, baseline, tolerance):
+    """Print the changes from baseline. Returns False on a regression."""
+    ok = True
+    speed = results['lines_per_second'] / baseline['lines_per_second'] - 1
+    print(f'lines/s: {baseline["lines_per_second"]} -> {results["lines_per_second"]} ({speed:+.1%})')
+    if speed < -tolerance:
+        print(f'Regression: lines/s dropped more than {tolerance:.0%}')
+        ok = False
+
+    (old, new) = (baseline['unresolved_rate']['any'], results['unresolved_rate']['any'])
+    print(f'unresolved: {old:.2%} -> {new:.2%}')
+    if new > old:
+        print('Regression: more lines are unresolved')
+        ok = False
+
+    if baseline['lines'] != results['lines']:
+        print(f'Note: the baseline has {baseline["lines"]} lines, this run {results["lines"]}')
+
+    return ok
+
+def parseargs():
+    parser = ArgumentParser(description='Benchmark the ingredient parser of grocycli.py over a corpus.')
+    filehelp = 'JSON file, glob or directory of JSON files, or recipe store with the corpus.'
+    parser.add_argument('file', type=str, help=filehelp)
+    cataloghelp = 'Catalog cached by grocycli.py to parse against instead of the mock catalog.'
+    parser.add_argument('--catalog', type=str, help=cataloghelp)
+    parser.add_argument('--products', type=int, default=1000, help='Number of products in the mock catalog')
+    parser.add_argument('--limit', type=int, help='Parse only the first this many lines')
+    parser.add_argument('--no-memoize', action='store_true', default=False,
+            help='Parse repeated lines again instead of using the memoized result')
+    parser.add_argument('--save', type=str, help='Save the results as a baseline to this file')
+    parser.add_argument('--baseline', type=str, help='Compare the results to this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help='Fraction lines/s may drop below the baseline. Default: 0.1')
+    parser.add_argument('--json', action='store_true', default=False, help='Print the results as JSON')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parseargs()
+
+    start = perf_counter()
+    lines = corpus_lines(args.file, args.limit)
+    load = perf_counter() - start
+    if not lines:
+        print(f'No ingredients found in "{args.file}"')
+        sys.exit(1)
+
+    catalog = Catalog.from_cache(args.catalog) if args.catalog else Catalog.from_mock(args.products)
+    results = run(lines, catalog, memoize=not args.no_memoize)
+    results['stage_us_per_line']['load'] = round(load / len(lines) * 1e6, 2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
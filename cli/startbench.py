@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""Measure how long grocycli.py takes to start, and fail when importing it
+exceeds a budget.
+
+Imports are timed with python -X importtime, the best of several runs so
+that the bytecode is cached, and the slowest modules imported by
+grocycli.py are listed. grocycli.py --help is timed against an interpreter
+that does nothing, e.g.
+
+    cli/startbench.py --budget 50"""
+
+from argparse import ArgumentParser
+import json
+from os import environ, path
+import re
+import subprocess
+import sys
+from time import perf_counter
+
+HERE = path.dirname(path.abspath(__file__))
+
+# Bytecode has to be written to be cached
+ENV = {x: y for (x, y) in environ.items() if x != 'PYTHONDONTWRITEBYTECODE'}
+
+# import time: self [us] | cumulative | imported package, indented by depth
+importtime_pat = re.compile(r'import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent> +)(?P<name>\S+)')
+
+def import_times(module):
+    """{module: cumulative microseconds} of one import of module and of the
+    modules it imports directly."""
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=HERE, env=ENV,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+
+    times = {}
+    stack = []
+    for line in res.stderr.splitlines():
+        amatch = importtime_pat.match(line)
+        if not amatch:
+            continue
+
+        # Children are reported before their parent
+        depth = len(amatch['indent'])
+        stack.append((depth, amatch['name'], int(amatch['cumulative'])))
+        if amatch['name'] == module:
+            times[module] = int(amatch['cumulative'])
+            times.update({x[1]: x[2] for x in stack if x[0] == depth + 2})
+        if depth == 1:
+            stack = []
+
+    return times
+
+def wall_time(cmd, runs):
+    """Best seconds of runs of cmd."""
+    best = None
+    for _ in range(runs):
+        start = perf_counter()
+        subprocess.run(cmd, cwd=HERE, env=ENV, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds = perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best
+
+def measure(runs, top):
+    best = None
+    for _ in range(runs):
+        times = import_times('grocycli')
+        if best is None or times['grocycli'] < best['grocycli']:
+            best = times
+
+    total = best.pop('grocycli')
+    slowest = sorted(best.items(), key=lambda x: x[1], reverse=True)[:top]
+    bare = wall_time([sys.executable, '-c', 'pass'], runs)
+    helptime = wall_time([sys.executable, path.join(HERE, 'grocycli.py'), '--help'], runs)
+
+    return {
+            'import_ms': round(total / 1000, 2),
+            'slowest_imports_ms': {x: round(y / 1000, 2) for (x, y) in slowest},
+            'interpreter_ms': round(bare * 1000, 2),
+            'help_ms': round(helptime * 1000, 2),
+            }
+
+def report(results):
+    print(f'Importing grocycli.py: {results["import_ms"]} ms')
+    for (name, ms) in results['slowest_imports_ms'].items():
+        print(f'  {ms:8.2f} {name}')
+    print(f'grocycli.py --help: {results["help_ms"]} ms, '
+            f'{results["help_ms"] - results["interpreter_ms"]:.2f} ms more than an empty interpreter')
+
+def parseargs():
+    parser = ArgumentParser(description='Measure the startup time of grocycli.py.')
+    parser.add_argument('--budget', type=float, default=50,
+            help='Milliseconds importing grocycli.py may take. Default: 50')
+    parser.add_argument('--runs', type=int, default=10, help='Measure the best of this many runs')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list')
+    parser.add_argument('--json', action='store_true', default=False, help='Print the results as JSON')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parseargs()
+    results = measure(args.runs, args.top)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+    if results['import_ms'] > args.budget:
+        print(f'Over budget: importing grocycli.py took more than {args.budget} ms')
+        sys.exit(1)
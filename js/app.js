@@ -1,22 +1,70 @@
-let all = []
+// Built by src/buildindex
+const INDEX_URL = "/recipes/search"
+// Rows rendered above and below the visible part of the queue
+const OVERSCAN = 10
 
-function addToQueue(recipe) {
-	$recipe = $("<li>")
-		.addClass("list-group-item")
-		.attr("id", recipe.title)
-		.text(recipe.title)
-		.on("click", recipe, async function(e) {
-			const data = e.data
-			console.log(data)
-			const recipe = await getRecipe(data.url)
-			showRecipe(recipe)
-		})
+let meta = null
+const indexFiles = new Map()
+const docShards = new Map()
 
-	$("#queue-ul").append($recipe)
+// The queue is a list of doc ids. Only the rows in view are in the DOM.
+let queueIds = []
+let rowHeight = 0
+let renderPending = false
+// Only the latest search may fill the queue
+let searchCount = 0
+
+function escapeHtml(text) {
+	return $("<div>").text(text).html()
+}
+
+// Redraw the queue once per animation frame at most
+function scheduleRender() {
+	if(renderPending) {
+		return
+	}
+
+	renderPending = true
+	requestAnimationFrame(function() {
+		renderPending = false
+		renderQueue()
+	})
 }
 
-async function clearQueue() {
-	$("#queue-ul").empty()
+function renderQueue() {
+	const queue = $("#queue")[0]
+	const ul = $("#queue-ul")[0]
+
+	if(!rowHeight) {
+		ul.innerHTML = '<li class="list-group-item">&nbsp;</li>'
+		rowHeight = ul.firstChild.offsetHeight || 40
+	}
+
+	const start = Math.max(0, Math.floor(queue.scrollTop / rowHeight) - OVERSCAN)
+	const end = Math.min(queueIds.length,
+		Math.ceil((queue.scrollTop + queue.clientHeight) / rowHeight) + OVERSCAN)
+
+	let html = ""
+	for(let i = start; i < end; i++) {
+		const docid = queueIds[i]
+		const doc = getDoc(docid)
+		const title = doc ? escapeHtml(doc[1]) : "&hellip;"
+		html += `<li class="list-group-item" data-docid="${docid}">${title}</li>`
+	}
+
+	ul.style.height = `${queueIds.length * rowHeight}px`
+	ul.style.paddingTop = `${start * rowHeight}px`
+	ul.innerHTML = html
+}
+
+function setQueue(docids) {
+	queueIds = docids
+	$("#queue")[0].scrollTop = 0
+	scheduleRender()
+}
+
+function clearQueue() {
+	setQueue([])
 }
 
 async function getRecipe(url) {
@@ -70,76 +118,116 @@ function showRecipe(recipe) {
 	$("#directions").html(html)
 }
 
-async function loadAvailableRecipes() {
-	console.log("Retrieving recipes")
-	const data = await $.ajax({
-		url: "/recipes",
-		type: "GET",
-		dataType: "text",
-	})
-
-	console.log("Parsing response")
-	$div = $("<div>").append($.parseHTML(data))
-	let lis = $div.find("li")
-
-	// Enable the next line to test a subset of available recipes
-	//lis = lis.slice(0,50) // DISABLE WHEN DONE TESTING
-
-	$.each(lis, function(idx, li) {
-		const $li = $(li)
-		const $a = $($li.find("a")[0])
-		const url = `/recipes/${$a.attr("href")}`
-		const title = $li.text().slice(0,-5)
-		item = { title: title, url: url }
-		all.push(item)
-		addToQueue(item)
-	})
+// Same as fnv1a() in src/buildindex. Tokens are ASCII, so char codes are bytes.
+function fnv1a(s) {
+	let h = 0x811c9dc5
+	for(let i = 0; i < s.length; i++) {
+		h = Math.imul(h ^ s.charCodeAt(i), 0x01000193) >>> 0
+	}
+	return h
+}
 
-	console.log(`Found ${all.length} recipes`)
+// Same as tokenize() in src/buildindex
+function tokenize(text) {
+	const tokens = text.toLowerCase().match(/[a-z]+/g) || []
+	return tokens
+		.filter(x => x.length > 1 && !meta.stopwords.includes(x))
+		.map(x => x.length > 3 && x.endsWith("s") && !x.endsWith("ss") ? x.slice(0, -1) : x)
 }
 
-async function populateQueue(items) {
-	console.log("Populating queue")
-	for(item of items) {
-		addToQueue(item)
+// Each index file is downloaded at most once
+function getIndexFile(name) {
+	if(!indexFiles.has(name)) {
+		indexFiles.set(name, $.ajax({
+			url: `${INDEX_URL}/${name}`,
+			type: "GET",
+			dataType: "json",
+		}))
 	}
+
+	return indexFiles.get(name)
 }
 
-// keyword is already lowercase
-async function keywordInRecipe(keyword, recipe) {
-	if(recipe.title.toLowerCase().includes(keyword)) {
-		return true
+async function getPostings(token) {
+	const shard = await getIndexFile(`terms-${fnv1a(token) % meta.term_shards}.json`)
+	return shard[token] || []
+}
+
+// [key, title] of docid, or null while its shard is loading
+function getDoc(docid) {
+	const shard = Math.floor(docid / meta.doc_shard_size)
+	const docs = docShards.get(shard)
+
+	if(!docs) {
+		if(!docShards.has(shard)) {
+			loadDocShard(shard)
+		}
+		return null
 	}
 
-	//for(ingredient of recipe.ingredients) {
-	//	if(ingredient.includes(keyword)) {
-	//		return true
-	//	}
-	//}
+	return docs[docid % meta.doc_shard_size]
+}
+
+async function loadDocShard(shard) {
+	// Mark the shard so that it's only requested once
+	docShards.set(shard, null)
+	docShards.set(shard, await getIndexFile(`docs-${shard}.json`))
+	scheduleRender()
+}
+
+function showAllRecipes() {
+	setQueue(Array.from({ length: meta.docs }, (_, i) => i))
+}
+
+async function loadAvailableRecipes() {
+	console.log("Retrieving search index")
+	meta = await getIndexFile("meta.json")
+	showAllRecipes()
+	console.log(`Found ${meta.docs} recipes`)
+}
+
+// Rank the recipes that contain every token in their title or ingredients
+async function rankRecipes(tokens) {
+	const postings = await Promise.all(tokens.map(getPostings))
+	let scores = null
+
+	for(list of postings) {
+		const idf = Math.log(1 + meta.docs / (list.length || 1))
+		const next = new Map()
+		for([docid, weight] of list) {
+			if(scores === null || scores.has(docid)) {
+				next.set(docid, (scores ? scores.get(docid) : 0) + weight * idf)
+			}
+		}
+		scores = next
+	}
 
-	return false
+	return [...scores.entries()]
+		.sort((a, b) => b[1] - a[1] || a[0] - b[0])
+		.map(x => x[0])
 }
 
 async function search() {
-	clearQueue()
-	let keyword = $("#searchbar").val().toLowerCase()
+	const keyword = $("#searchbar").val()
+	const tokens = tokenize(keyword)
+	const thisSearch = ++searchCount
 
-	console.log("Showing all recipes")
-	if(!keyword) {
-		populateQueue(all)
+	if(!tokens.length) {
+		console.log("Showing all recipes")
+		showAllRecipes()
 		return
 	}
 
-	console.log(`Searching for ${keyword}`)
-	let i = 0
-	for(item of all) {
-		const match = await keywordInRecipe(keyword, item)
-		if(match) {
-			addToQueue(item)
-			i += 1
-		}
+	console.log(`Searching for ${tokens}`)
+	clearQueue()
+	const docids = await rankRecipes(tokens)
+	if(thisSearch != searchCount) {
+		return
 	}
-	console.log(`Found ${i} recipes with keyword ${keyword}`)
+
+	// Titles are filled in as their doc shards arrive
+	setQueue(docids)
+	console.log(`Found ${docids.length} recipes with keyword ${keyword}`)
 }
 
 async function handleSearchKeyPress(event) {
@@ -148,9 +236,23 @@ async function handleSearchKeyPress(event) {
 	}
 }
 
-// TODO Load all recipe ingredients so that it's searchable
 $(document).ready(async function() {
 	console.log("Document ready")
+
+	$("#queue").on("scroll", scheduleRender)
+	$(window).on("resize", scheduleRender)
+
+	// One handler for every row, present and future
+	$("#queue-ul").on("click", "li[data-docid]", async function() {
+		const doc = getDoc(Number(this.dataset.docid))
+		if(!doc) {
+			return
+		}
+
+		const recipe = await getRecipe(`/api/recipes/${doc[0]}`)
+		showRecipe(recipe)
+	})
+
 	clearQueue()
 	await loadAvailableRecipes()
 })
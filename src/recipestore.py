@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+"""Consolidated store of crawled recipes.
+
+Every recipe is one row of a SQLite database, keyed by a hash of its URL and
+holding the recipe JSON encoded once. Looking up a recipe by key is a single
+index lookup, and crawling the same recipe again replaces its row instead of
+adding a file.
+
+Every recipe also gets a MinHash fingerprint of its ingredients and
+instructions. Banded locality-sensitive hashing finds the recipes it may be
+a near-duplicate of, e.g. the same recipe republished on another host, in a
+few index lookups instead of a comparison with every recipe."""
+
+from argparse import ArgumentParser
+from glob import glob
+from hashlib import sha1
+import json
+import os
+from random import Random
+import re
+import sqlite3
+from threading import local
+from time import time
+from urllib.parse import urlparse
+
+STORE_DB = "recipes.db"
+# MinHash values per fingerprint, compared in BANDS bands of ROWS values
+PERMUTATIONS = 64
+BANDS = 16
+ROWS = PERMUTATIONS // BANDS
+# Estimated Jaccard similarity from which recipes are duplicates
+DUP_THRESHOLD = 0.8
+# Words per shingle
+SHINGLE = 3
+
+MERSENNE = (1 << 61) - 1
+# Seeded, so that fingerprints stay comparable between runs
+rng = Random(1)
+permutations = [(rng.randrange(1, MERSENNE), rng.randrange(MERSENNE)) for _ in range(PERMUTATIONS)]
+word_pat = re.compile(r"[a-z]+")
+
+
+def recipe_key(url):
+	return sha1(url.encode("utf-8")).hexdigest()[:16]
+
+
+def recipe_etag(data):
+	"""Tag of the recipe JSON text data, for HTTP caching."""
+	return sha1(data.encode("utf-8")).hexdigest()[:16]
+
+
+def fingerprint(recipe):
+	"""MinHash signature of the ingredients and instructions of recipe, as a
+	tuple of PERMUTATIONS ints, or None when it has neither. Amounts,
+	punctuation and case are ignored."""
+	ingredients = recipe.get("ingredients") or []
+	if isinstance(ingredients, str):
+		ingredients = [ingredients]
+	text = " ".join(ingredients + [recipe.get("instructions") or ""]).lower()
+
+	words = word_pat.findall(text)
+	if not words:
+		return None
+
+	shingles = {" ".join(words[i:i + SHINGLE]) for i in range(max(len(words) - SHINGLE + 1, 1))}
+	hashes = [int.from_bytes(sha1(x.encode("utf-8")).digest()[:8], "little") for x in shingles]
+	return tuple(min((a * x + b) % MERSENNE for x in hashes) for (a, b) in permutations)
+
+
+def similarity(sig1, sig2):
+	"""Estimated Jaccard similarity of two fingerprints."""
+	return sum(x == y for (x, y) in zip(sig1, sig2)) / PERMUTATIONS
+
+
+def band_hashes(signature):
+	"""(band, hash) of every band of signature, fitting an SQLite integer."""
+	for band in range(BANDS):
+		values = ",".join(map(str, signature[band * ROWS:(band + 1) * ROWS]))
+		yield (band, int.from_bytes(sha1(values.encode("utf-8")).digest()[:7], "little"))
+
+
+class RecipeStore():
+	"""Recipes in <path>/recipes.db. Safe to use from several threads and
+	processes at once."""
+
+	schema = """
+		CREATE TABLE IF NOT EXISTS recipes (
+			key TEXT PRIMARY KEY,
+			url TEXT NOT NULL,
+			host TEXT,
+			title TEXT,
+			updated REAL NOT NULL,
+			data TEXT NOT NULL,
+			created REAL
+		);
+		CREATE INDEX IF NOT EXISTS recipes_title ON recipes (title);
+		CREATE TABLE IF NOT EXISTS encoded (
+			key TEXT PRIMARY KEY,
+			etag TEXT NOT NULL,
+			gzip BLOB,
+			br BLOB
+		);
+		CREATE TABLE IF NOT EXISTS fingerprints (
+			key TEXT PRIMARY KEY,
+			signature TEXT NOT NULL,
+			duplicate_of TEXT
+		);
+		CREATE INDEX IF NOT EXISTS fingerprints_duplicate_of ON fingerprints (duplicate_of);
+		CREATE TABLE IF NOT EXISTS bands (
+			band INTEGER NOT NULL,
+			hash INTEGER NOT NULL,
+			key TEXT NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS bands_hash ON bands (band, hash);
+		CREATE INDEX IF NOT EXISTS bands_key ON bands (key);
+	"""
+
+	def __init__(self, path):
+		self.path = os.path.join(path, STORE_DB)
+		self.local = local()
+
+		db = self.db()
+		db.execute("PRAGMA journal_mode=WAL")
+		db.executescript(self.schema)
+
+		# Stores of earlier crawls lack the time a recipe was first stored
+		columns = [x[1] for x in db.execute("PRAGMA table_info(recipes)")]
+		if "created" not in columns:
+			with db:
+				db.execute("ALTER TABLE recipes ADD COLUMN created REAL")
+				db.execute("UPDATE recipes SET created = updated")
+
+	def db(self):
+		"""Connection of the calling thread."""
+		if not hasattr(self.local, "db"):
+			self.local.db = sqlite3.connect(self.path, timeout=60)
+			self.local.db.execute("PRAGMA synchronous=NORMAL")
+
+		return self.local.db
+
+	def __contains__(self, key):
+		row = self.db().execute("SELECT 1 FROM recipes WHERE key = ?", (key,)).fetchone()
+		return row is not None
+
+	def __len__(self):
+		return self.db().execute("SELECT COUNT(*) FROM recipes").fetchone()[0]
+
+	def count_unique(self):
+		"""Number of recipes that aren't near-duplicates, as listed by
+		titles()."""
+		return self.db().execute(
+			"SELECT COUNT(*) FROM recipes WHERE key NOT IN "
+			"(SELECT key FROM fingerprints WHERE duplicate_of IS NOT NULL)").fetchone()[0]
+
+	def get(self, key):
+		"""Recipe JSON text of key, or None."""
+		row = self.db().execute("SELECT data FROM recipes WHERE key = ?", (key,)).fetchone()
+		return row[0] if row else None
+
+	def load(self, key):
+		"""Recipe of key as a dict, or None."""
+		data = self.get(key)
+		return json.loads(data) if data else None
+
+	def put(self, url, recipe, duplicates=True):
+		"""Store recipe, replacing any recipe from the same URL but keeping
+		when it was first stored. Return (key, original), original being the
+		key of the recipe it is a near-duplicate of, or None. A near-duplicate
+		is stored marked as such, or not at all without duplicates."""
+		if isinstance(recipe, str):
+			recipe = json.loads(recipe)
+
+		key = recipe_key(url)
+		signature = fingerprint(recipe)
+		now = time()
+
+		db = self.db()
+		# Looked up under the write lock, so that copies stored at the same
+		# time by other threads or processes aren't all originals
+		db.execute("BEGIN IMMEDIATE")
+		with db:
+			original = self.find_duplicate(signature, key) if signature else None
+			if original and not duplicates:
+				return (key, original)
+
+			db.execute(
+				"INSERT INTO recipes (key, url, host, title, updated, data, created) VALUES (?, ?, ?, ?, ?, ?, ?) "
+				"ON CONFLICT (key) DO UPDATE SET url = excluded.url, host = excluded.host, "
+				"title = excluded.title, updated = excluded.updated, data = excluded.data",
+				(key, url, urlparse(url).netloc, recipe.get("title"), now, json.dumps(recipe), now))
+			self.put_fingerprint(db, key, signature, original)
+
+		return (key, original)
+
+	def put_fingerprint(self, db, key, signature, duplicate):
+		db.execute("DELETE FROM bands WHERE key = ?", (key,))
+		db.execute("DELETE FROM fingerprints WHERE key = ?", (key,))
+		if not signature:
+			return
+
+		db.execute("INSERT INTO fingerprints (key, signature, duplicate_of) VALUES (?, ?, ?)",
+			(key, json.dumps(signature), duplicate))
+		# Only originals are candidates, so that clusters don't chain
+		if not duplicate:
+			db.executemany("INSERT INTO bands (band, hash, key) VALUES (?, ?, ?)",
+				[(band, value, key) for (band, value) in band_hashes(signature)])
+
+	def find_duplicate(self, signature, key=None):
+		"""Key of the most similar stored recipe, other than key, that the
+		recipe with signature is a near-duplicate of, or None."""
+		db = self.db()
+		candidates = set()
+		for (band, value) in band_hashes(signature):
+			rows = db.execute("SELECT key FROM bands WHERE band = ? AND hash = ?", (band, value))
+			candidates.update(x[0] for x in rows)
+		candidates.discard(key)
+
+		best = (DUP_THRESHOLD, None)
+		for candidate in sorted(candidates):
+			row = db.execute("SELECT signature FROM fingerprints WHERE key = ?", (candidate,)).fetchone()
+			score = similarity(signature, json.loads(row[0])) if row else 0
+			if score >= best[0]:
+				best = (score, candidate)
+
+		return best[1]
+
+	def dedup(self, delete=False):
+		"""Fingerprint every recipe again and mark the near-duplicates of
+		recipes stored before them, or delete them. Return (recipes,
+		duplicates)."""
+		db = self.db()
+		with db:
+			db.execute("DELETE FROM bands")
+			db.execute("DELETE FROM fingerprints")
+
+		count = 0
+		duplicates = 0
+		rows = db.execute("SELECT key, data FROM recipes ORDER BY created, key").fetchall()
+		for (key, data) in rows:
+			signature = fingerprint(json.loads(data))
+			duplicate = self.find_duplicate(signature, key) if signature else None
+			with db:
+				if duplicate and delete:
+					db.execute("DELETE FROM recipes WHERE key = ?", (key,))
+				else:
+					self.put_fingerprint(db, key, signature, duplicate)
+
+			count += 1
+			duplicates += bool(duplicate)
+
+		return (count, duplicates)
+
+	def duplicates(self):
+		"""(key, duplicate_of) of every recipe marked as a near-duplicate."""
+		return self.db().execute(
+			"SELECT key, duplicate_of FROM fingerprints WHERE duplicate_of IS NOT NULL ORDER BY duplicate_of")
+
+	def get_encoded(self, key):
+		"""(data, etag, gzip, br) of key, or None. The compressed variants are
+		None when they are missing or older than data."""
+		row = self.db().execute(
+			"SELECT r.data, e.etag, e.gzip, e.br FROM recipes r LEFT JOIN encoded e ON e.key = r.key WHERE r.key = ?",
+			(key,)).fetchone()
+		if not row:
+			return None
+
+		(data, etag, gzip, br) = row
+		if etag != recipe_etag(data):
+			return (data, recipe_etag(data), None, None)
+
+		return (data, etag, gzip, br)
+
+	def stale_encoded(self):
+		"""Keys of the recipes whose compressed variants are missing or out of
+		date."""
+		rows = self.db().execute(
+			"SELECT r.key, r.data, e.etag FROM recipes r LEFT JOIN encoded e ON e.key = r.key")
+		return [key for (key, data, etag) in rows if etag != recipe_etag(data)]
+
+	def put_encoded(self, rows):
+		"""Store (key, etag, gzip, br) rows of compressed variants."""
+		db = self.db()
+		with db:
+			db.executemany("INSERT OR REPLACE INTO encoded (key, etag, gzip, br) VALUES (?, ?, ?, ?)", rows)
+
+	def titles(self, limit=-1, offset=0):
+		"""(key, title) of the recipes that aren't near-duplicates, ordered
+		by title."""
+		return self.db().execute(
+			"SELECT key, title FROM recipes WHERE key NOT IN "
+			"(SELECT key FROM fingerprints WHERE duplicate_of IS NOT NULL) "
+			"ORDER BY title LIMIT ? OFFSET ?",
+			(limit, offset))
+
+	def items(self):
+		"""(key, recipe JSON text) of every recipe that isn't a
+		near-duplicate."""
+		return self.db().execute(
+			"SELECT key, data FROM recipes WHERE key NOT IN "
+			"(SELECT key FROM fingerprints WHERE duplicate_of IS NOT NULL)")
+
+	def compact(self):
+		db = self.db()
+		with db:
+			db.execute("DELETE FROM encoded WHERE key NOT IN (SELECT key FROM recipes)")
+			db.execute("DELETE FROM bands WHERE key NOT IN (SELECT key FROM recipes)")
+			db.execute("DELETE FROM fingerprints WHERE key NOT IN (SELECT key FROM recipes)")
+		db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+		db.execute("VACUUM")
+
+
+def import_files(store, paths):
+	"""Import recipes saved as one JSON file each by earlier crawls."""
+	count = 0
+	for path in paths:
+		with open(path, "r") as fp:
+			recipe = json.load(fp)
+
+		# Early crawls stored the JSON text as a JSON string
+		if isinstance(recipe, str):
+			recipe = json.loads(recipe)
+
+		url = recipe.get("canonical_url")
+		if not url:
+			print(f"No URL in {path}. Skipping.")
+			continue
+
+		store.put(url, recipe)
+		count += 1
+
+	return count
+
+
+def parseargs():
+	parser = ArgumentParser(description="Manage the consolidated recipe store.")
+	parser.add_argument("--dir", type=str, default="recipes", help="Directory of the store")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	pimport = subparsers.add_parser("import", help="Import recipe JSON files.")
+	pimport.add_argument("files", type=str, nargs="+", help="JSON files or directories of JSON files")
+
+	subparsers.add_parser("compact", help="Reclaim space left by replaced recipes.")
+
+	pdedup = subparsers.add_parser("dedup",
+		help="Find the recipes that are near-duplicates of recipes stored before them.")
+	deletehelp = "Delete the near-duplicates instead of marking them"
+	pdedup.add_argument("--delete", action="store_true", default=False, help=deletehelp)
+	listhelp = "List every near-duplicate and the recipe it duplicates"
+	pdedup.add_argument("--list", action="store_true", default=False, help=listhelp)
+	return parser.parse_args()
+
+
+if __name__ == "__main__":
+	args = parseargs()
+	store = RecipeStore(args.dir)
+
+	if args.command == "import":
+		paths = []
+		for path in args.files:
+			paths += sorted(glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+
+		count = import_files(store, paths)
+		print(f"Imported {count} recipes. The store holds {len(store)} recipes.")
+	elif args.command == "compact":
+		store.compact()
+	elif args.command == "dedup":
+		(count, duplicates) = store.dedup(delete=args.delete)
+		action = "Deleted" if args.delete else "Found"
+		print(f"{action} {duplicates} near-duplicates among {count} recipes.")
+
+		if args.list:
+			for (key, original) in store.duplicates():
+				print(f"{key} duplicates {original}")
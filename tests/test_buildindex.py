@@ -0,0 +1,43 @@
+"""Tests of the search index build, src/buildindex."""
+
+import gzip
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+import os
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+@pytest.fixture
+def buildindex(monkeypatch):
+	"""src/buildindex as a module."""
+	monkeypatch.syspath_prepend(SRC)
+	loader = SourceFileLoader("buildindex", os.path.join(SRC, "buildindex"))
+	module = module_from_spec(spec_from_loader("buildindex", loader))
+	loader.exec_module(module)
+	return module
+
+
+def test_precompress_gzip_only_without_brotli(buildindex, tmp_path, monkeypatch):
+	monkeypatch.setattr(buildindex, "brotli", None)
+	path = tmp_path / "meta.json"
+	path.write_text('{"docs": 0}')
+
+	assert buildindex.precompress(str(path))
+	assert gzip.decompress((tmp_path / "meta.json.gz").read_bytes()) == b'{"docs": 0}'
+	assert not (tmp_path / "meta.json.br").exists()
+	assert buildindex.compress(b"x")[1] is None
+	# The .gz alone is up to date
+	assert not buildindex.precompress(str(path))
+
+
+def test_precompress_brotli(buildindex, tmp_path):
+	brotli = pytest.importorskip("brotli")
+	path = tmp_path / "meta.json"
+	path.write_text('{"docs": 0}')
+
+	assert buildindex.precompress(str(path))
+	assert brotli.decompress((tmp_path / "meta.json.br").read_bytes()) == b'{"docs": 0}'
+	assert not buildindex.precompress(str(path))
@@ -0,0 +1,125 @@
+"""Tests of the crawler, src/doit."""
+
+from argparse import Namespace
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+import os
+import sqlite3
+import sys
+
+import pytest
+
+pytest.importorskip("recipe_scrapers")
+pytest.importorskip("requests")
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+@pytest.fixture
+def doit(tmp_path, monkeypatch):
+	"""src/doit as a module, storing recipes in tmp_path."""
+	monkeypatch.syspath_prepend(SRC)
+	loader = SourceFileLoader("doit", os.path.join(SRC, "doit"))
+	module = module_from_spec(spec_from_loader("doit", loader))
+	loader.exec_module(module)
+
+	from recipestore import RecipeStore
+	module.store = RecipeStore(str(tmp_path))
+	monkeypatch.setattr(module, "scraper_exists_for", lambda url: True)
+	module.host_has_scraper.cache_clear()
+	return module
+
+
+class Response():
+	status_code = 200
+	content = b"<html></html>"
+	url = "https://example.com/recipes/chili"
+	headers = {}
+
+
+class Page():
+	"""Scraper result of a page without a recipe."""
+
+	def __init__(self, hrefs):
+		self.hrefs = hrefs
+
+	def to_json(self):
+		return {"title": "Chili", "ingredients": []}
+
+	def links(self):
+		return [{"href": x} for x in self.hrefs]
+
+
+@pytest.mark.parametrize("url", ["https://[broken/x", "http://example.com:port/", "https://[::1"])
+def test_canonicalize_malformed(doit, url):
+	assert doit.canonicalize(url) is None
+	assert doit.canonicalize(url, "https://example.com/") is None
+
+
+def test_parserecipe_skips_malformed_links(doit, monkeypatch):
+	page = Page(["https://[broken/x", "/recipes/beans", "https://example.com/recipes/chili#top"])
+	monkeypatch.setattr(doit, "fetch", lambda url, meta: Response())
+	monkeypatch.setattr(doit, "scrape_html", lambda content, org_url: page)
+
+	(links, meta, found) = doit.parserecipe(Response.url)
+
+	assert links == ["https://example.com/recipes/beans"]
+	assert meta["url"] == Response.url
+	assert found is False
+
+
+def test_parserecipe_keeps_links_as_linked(doit, monkeypatch):
+	page = Page(["/recipes/beans/;v=2?b=1&a=%20", "/recipes/beans;v=2?a=+&b=1&utm_source=x#top"])
+	monkeypatch.setattr(doit, "fetch", lambda url, meta: Response())
+	monkeypatch.setattr(doit, "scrape_html", lambda content, org_url: page)
+
+	(links, meta, found) = doit.parserecipe(Response.url)
+
+	assert links == ["https://example.com/recipes/beans/;v=2?b=1&a=%20"]
+
+
+def test_visited_log_keys_old_urls(doit, tmp_path):
+	path = tmp_path / "cache.txt"
+	path.write_text("https://Example.com/recipes/chili/\nhttps://example.com/recipes/beans\n")
+
+	visited = doit.VisitedLog(str(path))
+
+	assert doit.url_key("https://example.com/recipes/chili?utm_source=x") in visited
+	assert set(path.read_text().split()) == visited.urls
+	assert len(visited) == 2
+
+
+def test_shared_state_keys_old_urls(doit, tmp_path):
+	path = str(tmp_path / "crawl.db")
+	db = sqlite3.connect(path)
+	db.executescript("""
+		CREATE TABLE urls (url TEXT PRIMARY KEY, shard INTEGER NOT NULL,
+			state INTEGER NOT NULL DEFAULT 0, etag TEXT, last_modified TEXT, sha256 TEXT);
+		INSERT INTO urls (url, shard, state, sha256) VALUES
+			('https://example.com/recipes/chili/', 0, 2, 'abc'),
+			('https://example.com/recipes/chili', 0, 0, NULL);
+	""")
+	db.close()
+
+	state = doit.SharedState(path, 0, 1)
+
+	assert state.push(["https://EXAMPLE.com/recipes/chili?utm_source=x"]) == []
+	assert state.meta("https://example.com/recipes/chili")["sha256"] == "abc"
+	rows = state.db.execute("SELECT url, href, state FROM urls").fetchall()
+	assert rows == [("https://example.com/recipes/chili", "https://example.com/recipes/chili/", 2)]
+	state.close()
+
+
+def test_crawl_survives_crashing_page(doit, tmp_path, monkeypatch):
+	def crash(url, meta):
+		raise RuntimeError("boom")
+
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(doit, "parserecipe", crash)
+	args = Namespace(url=Response.url, workers=2, recrawl=False)
+	state = doit.LocalState()
+
+	doit.crawl(args, state)
+
+	assert Response.url in state.visited
+	assert len(state.frontier) == 0